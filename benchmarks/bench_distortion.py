@@ -0,0 +1,34 @@
+"""point distortion and undistortion"""
+import benchmarks.common as common
+
+class DistortPoints(object):
+    params = [10**3, 10**4, 10**5, 10**6, 10**7]
+    param_names = ['n_points']
+
+    def setup(self, n_points):
+        self.model = common.make_model()
+        self.x, self.y = common.make_points(n_points)
+
+    def time_distort(self, n_points):
+        self.model.distort(self.x,self.y)
+
+    def time_undistort(self, n_points):
+        self.model.undistort(self.x,self.y)
+
+    def time_undistort_tol(self, n_points):
+        self.model.undistort(self.x,self.y,tol=1e-6)
+
+class ApproximateUndistort(object):
+    params = [10**3, 10**5, 10**7]
+    param_names = ['n_points']
+
+    def setup(self, n_points):
+        self.model = common.make_model()
+        self.approx = self.model.build_approximate_inverse((480,640))
+        self.x, self.y = common.make_points(n_points)
+
+    def time_undistort(self, n_points):
+        self.approx.undistort(self.x,self.y)
+
+    def track_max_error(self, n_points):
+        return self.approx.max_error
@@ -0,0 +1,35 @@
+"""estimation of distortion parameters from straight lines"""
+import pinpoint.distortion as distortion
+import pinpoint.distortion_estimate as distortion_estimate
+
+import benchmarks.common as common
+
+class FitLines(object):
+    params = [2, 10, 50, 500]
+    param_names = ['n_lines']
+    timeout = 120
+
+    def setup(self, n_lines):
+        lines = common.make_lines(common.make_model(), n_lines)
+        self.obj = distortion_estimate.Objective(
+            lines, distortion_center_guess=(320,240))
+        guess = distortion.CaltechNonlinearDistortionModel(cc1=320, cc2=240)
+        self.p0 = self.obj.get_default_p0(guess)
+
+    def time_err(self, n_lines):
+        # undistortion plus residuals, as before the undistort cache
+        self.obj.clear_undistort_cache()
+        self.obj.lm_err_func(self.p0)
+
+    def time_err_cached(self, n_lines):
+        # residuals only, with the undistorted points from the cache
+        self.obj.lm_err_func(self.p0)
+
+    def time_jac_blocks(self, n_lines):
+        self.obj.lm_jac_blocks(self.p0)
+
+    def time_solve(self, n_lines):
+        self.obj.solve(self.p0)
+
+    def track_final_err(self, n_lines):
+        return self.obj.sumsq_err(self.obj.solve(self.p0))
@@ -0,0 +1,26 @@
+"""loading and saving of .dat files"""
+import os
+import shutil
+import tempfile
+
+import pinpoint.util as util
+
+import benchmarks.common as common
+
+class DatFiles(object):
+    params = ['IdMat', 'points', 'Res']
+    param_names = ['name']
+
+    def setup(self, name):
+        self.filename = os.path.join(common.DATA_DIR,name+'.dat')
+        self.M = util.load_dat_file(self.filename)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self, name):
+        shutil.rmtree(self.tmpdir)
+
+    def time_load(self, name):
+        util.load_dat_file(self.filename)
+
+    def time_save(self, name):
+        util.save_dat_file(self.M,os.path.join(self.tmpdir,name+'.dat'))
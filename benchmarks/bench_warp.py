@@ -0,0 +1,47 @@
+"""removal of distortion from images"""
+import numpy as np
+
+import benchmarks.common as common
+
+class RemoveDistortion(object):
+    params = [sorted(common.IMAGE_SHAPES.keys()), [1, 3]]
+    param_names = ['size', 'channels']
+
+    def setup(self, size, channels):
+        shape = common.IMAGE_SHAPES[size]
+        if channels > 1:
+            shape = shape + (channels,)
+        rng = np.random.RandomState(0)
+        self.img = rng.randint(0,256,shape).astype(np.uint8)
+        self.model = common.make_model()
+        # fill the remap cache
+        self.model.build_remap(self.img.shape)
+
+    def time_remove_distortion(self, size, channels):
+        self.model.remove_distortion(self.img)
+
+    def time_remove_distortion_uncached(self, size, channels):
+        self.model._clear_remap_cache()
+        self.model.remove_distortion(self.img)
+
+class RemoveDistortionMapDtype(object):
+    params = [sorted(common.IMAGE_SHAPES.keys()),
+              ['float64', 'float32', 'int16']]
+    param_names = ['size', 'map_dtype']
+
+    def setup(self, size, map_dtype):
+        shape = common.IMAGE_SHAPES[size]
+        rng = np.random.RandomState(0)
+        self.img = rng.randint(0,256,shape).astype(np.uint8)
+        self.out = None
+        self.model = common.make_model()
+        try:
+            self.out = self.model.remove_distortion(self.img,
+                                                    map_dtype=map_dtype)[0]
+        except ValueError:
+            # offsets too large for fixed point maps
+            raise NotImplementedError
+
+    def time_remove_distortion_out(self, size, map_dtype):
+        self.model.remove_distortion(self.img,out=self.out,
+                                     map_dtype=map_dtype)
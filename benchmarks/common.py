@@ -0,0 +1,46 @@
+"""shared fixtures of the benchmarks"""
+import os
+
+import numpy as np
+
+import pinpoint.distortion as distortion
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..','data','nview','mamarama-20080528')
+
+IMAGE_SHAPES = {'vga':(480,640),
+                '720p':(720,1280),
+                '1080p':(1080,1920),
+                '4k':(2160,3840),
+                }
+
+def make_model():
+    """a moderately distorting model centred on a VGA image"""
+    return distortion.CaltechNonlinearDistortionModel(fc1=1000.0,
+                                                      fc2=1000.0,
+                                                      cc1=321.0,
+                                                      cc2=242.0,
+                                                      k1=0.3,
+                                                      k2=0.05,
+                                                      p1=0.001,
+                                                      p2=-0.002)
+
+def make_points(n, seed=0):
+    """n random (x, y) image coordinates of a VGA image"""
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0,640,n), rng.uniform(0,480,n)
+
+def make_lines(model, n_lines, n_points=30, noise=0.1, seed=0):
+    """n_lines distorted straight lines with gaussian pixel noise"""
+    rng = np.random.RandomState(seed)
+    lines = []
+    for i in range(n_lines):
+        theta = rng.uniform(0,np.pi)
+        dist = rng.uniform(-150,150)
+        t = np.linspace(-250,250,n_points)
+        x = 320+dist*np.cos(theta)-t*np.sin(theta)
+        y = 240+dist*np.sin(theta)+t*np.cos(theta)
+        dx, dy = model.distort(x,y)
+        xys = np.column_stack((dx,dy))+rng.normal(0,noise,(n_points,2))
+        lines.append(xys)
+    return lines
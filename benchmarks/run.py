@@ -0,0 +1,140 @@
+"""run the benchmarks without asv and write the results as JSON
+
+The benchmarks follow the conventions of asv (airspeed velocity):
+classes in the bench_*.py modules with optional params, param_names,
+setup() and teardown(), whose time_* methods are timed and whose
+track_* methods return a value to record. With asv installed, run
+them with "asv run" from the top directory. This script runs them in
+the current environment instead:
+
+    python benchmarks/run.py -o results.json [-b REGEX]
+
+Each result records the benchmark name, its parameters and either
+the best time per call in seconds or the tracked value.
+"""
+import os
+import sys
+import re
+import glob
+import time
+import json
+import inspect
+import itertools
+import platform
+from optparse import OptionParser
+
+import numpy as np
+
+def _iter_benchmark_classes():
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in sorted(glob.glob(os.path.join(bench_dir,'bench_*.py'))):
+        modname = os.path.splitext(os.path.basename(filename))[0]
+        module = __import__('benchmarks.'+modname,fromlist=[modname])
+        for name, cls in sorted(vars(module).items()):
+            if inspect.isclass(cls) and cls.__module__ == module.__name__:
+                yield modname, cls
+
+def _iter_params(cls):
+    params = getattr(cls,'params',None)
+    if params is None:
+        yield ()
+        return
+    if not len(params) or not isinstance(params[0],(list,tuple)):
+        params = [params]
+    for combination in itertools.product(*params):
+        yield combination
+
+def _time_call(func, args, min_time, repeat):
+    """return the best time of a single call of func(*args)"""
+    number = 1
+    while 1:
+        start = time.time()
+        for i in range(number):
+            func(*args)
+        elapsed = time.time()-start
+        if elapsed >= min_time or number >= 1e6:
+            break
+        number *= 10
+    best = elapsed/number
+    for i in range(repeat-1):
+        start = time.time()
+        for j in range(number):
+            func(*args)
+        best = min(best,(time.time()-start)/number)
+    return best, number
+
+def run(pattern=None, min_time=0.05, repeat=3, stream=sys.stdout):
+    """run all matching benchmarks and return a list of result dicts"""
+    results = []
+    for modname, cls in _iter_benchmark_classes():
+        param_names = getattr(cls,'param_names',[])
+        methods = [name for name in sorted(dir(cls))
+                   if name.startswith('time_') or name.startswith('track_')]
+        for method in methods:
+            fullname = '%s.%s.%s'%(modname,cls.__name__,method)
+            if pattern is not None and not re.search(pattern,fullname):
+                continue
+            for args in _iter_params(cls):
+                bench = cls()
+                params = dict(zip(param_names,args))
+                result = {'name':fullname, 'params':params}
+                try:
+                    if hasattr(bench,'setup'):
+                        bench.setup(*args)
+                except NotImplementedError:
+                    continue
+                try:
+                    func = getattr(bench,method)
+                    if method.startswith('time_'):
+                        value, number = _time_call(func,args,min_time,repeat)
+                        result.update({'kind':'time', 'unit':'seconds',
+                                       'value':value, 'number':number,
+                                       'repeat':repeat})
+                    else:
+                        result.update({'kind':'track',
+                                       'value':float(func(*args))})
+                finally:
+                    if hasattr(bench,'teardown'):
+                        bench.teardown(*args)
+                results.append(result)
+                if stream is not None:
+                    stream.write('%-60s %-30s %.6g\n'%(
+                        fullname, ','.join('%s=%s'%(k,params[k])
+                                           for k in param_names),
+                        result['value']))
+                    stream.flush()
+    return results
+
+def main():
+    usage = '%prog [options]'
+    parser = OptionParser(usage)
+    parser.add_option('-o', '--output', type='string', default=None,
+                      help='write the results as JSON to this file')
+    parser.add_option('-b', '--bench', type='string', default=None,
+                      help='only run benchmarks whose name matches REGEX',
+                      metavar='REGEX')
+    parser.add_option('--min-time', type='float', default=0.05,
+                      help='minimum duration of a timing sample in seconds '
+                      '[default: %default]')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='number of timing samples [default: %default]')
+    (options, args) = parser.parse_args()
+
+    sys.path.insert(0,os.path.join(os.path.dirname(
+        os.path.abspath(__file__)),'..'))
+    results = run(pattern=options.bench, min_time=options.min_time,
+                  repeat=options.repeat)
+    if options.output is not None:
+        info = {'python':platform.python_version(),
+                'numpy':np.__version__,
+                'machine':platform.machine(),
+                'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results':results,
+                }
+        fd = open(options.output,mode='w')
+        json.dump(info,fd,indent=1,sort_keys=True)
+        fd.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""removal of distortion from many image files on a pool of processes
+
+The distortion helper of the model (a picklable
+pinpoint._caltech_distortion.CaltechDistortion) and the remap table
+for the size of the first image are sent to each worker process once,
+when the pool starts. The files are then streamed through the workers
+and the results are returned in the order of the input files. A file
+which cannot be read, undistorted or written is reported and does not
+stop the run.
+"""
+import os
+import sys
+import traceback
+import multiprocessing
+from optparse import OptionParser
+
+import numpy as np
+import scipy
+import scipy.misc.pilutil
+
+import pinpoint.distortion as distortion
+import pinpoint.pipeline as pipeline
+
+# state of a worker process, set by _init_worker()
+_worker = {}
+
+def _init_worker(helper, remap, options):
+    model = distortion.CaltechNonlinearDistortionModel(
+        fc1=helper.fc1, fc2=helper.fc2, cc1=helper.cc1, cc2=helper.cc2,
+        k1=helper.k1, k2=helper.k2, p1=helper.p1, p2=helper.p2,
+        alpha_c=helper.alpha_c)
+    remaps = {}
+    if remap is not None:
+        shape, table = remap
+        remaps[shape] = table
+    _worker['model'] = model
+    _worker['remaps'] = remaps
+    _worker['options'] = options
+
+def _undistort_file(filename):
+    """undistort one file, returns (filename, output filename, error)"""
+    options = _worker['options']
+    try:
+        img = scipy.misc.pilutil.imread(filename)
+        shape = img.shape[:2]
+        remap = _worker['remaps'].get(shape)
+        if remap is None:
+            remap = _worker['model'].build_remap(
+                shape, reshape=options['reshape'],
+                dtype=options['map_dtype'])
+            _worker['remaps'][shape] = remap
+        restored_img = remap.apply(img, mode=options['mode'], threads=1)
+        out_name = pipeline.output_filename(filename, options['out_dir'],
+                                            options['ext'])
+        scipy.misc.pilutil.imsave(out_name, restored_img)
+    except Exception:
+        return filename, None, traceback.format_exc()
+    return filename, out_name, None
+
+def undistort_files(filenames, model, out_dir, workers=None, reshape=True,
+                    mode='bilinear', ext=None, map_dtype=np.float64,
+                    callback=None):
+    """remove distortion from image files and save them to out_dir
+
+    Parameters
+    ----------
+    filenames : sequence of strings
+        The image files to process.
+    model : CaltechNonlinearDistortionModel
+        The distortion model.
+    out_dir : string
+        Directory for the output images, which get the basename of the
+        input files.
+
+    Other Parameters
+    ----------------
+    workers : int
+        Number of worker processes. Defaults to the number of CPUs. With
+        1 worker, the files are processed in the calling process.
+    reshape, mode, map_dtype
+        See CaltechNonlinearDistortionModel.remove_distortion().
+    ext : string
+        Extension (and format) of the output images, by default that
+        of the input.
+    callback : callable
+        Called with each result tuple as soon as it is available.
+
+    Returns
+    -------
+    results : list
+        A (filename, output filename, error) tuple for each file, in
+        the order of filenames. For failed files, the output filename
+        is None and error is the formatted traceback, otherwise error
+        is None.
+    """
+    filenames = list(filenames)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    options = dict(out_dir=out_dir, reshape=reshape, mode=mode, ext=ext,
+                   map_dtype=map_dtype)
+
+    # build the remap table for the (presumably common) image size once
+    remap = None
+    if len(filenames):
+        try:
+            shape = scipy.misc.pilutil.imread(filenames[0]).shape[:2]
+        except Exception:
+            pass
+        else:
+            remap = (shape, model.build_remap(shape, reshape=reshape,
+                                              dtype=map_dtype))
+
+    initargs = (model.helper, remap, options)
+    results = []
+    if workers <= 1 or len(filenames) <= 1:
+        _init_worker(*initargs)
+        for filename in filenames:
+            result = _undistort_file(filename)
+            if callback is not None:
+                callback(result)
+            results.append(result)
+        return results
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=initargs)
+    try:
+        for result in pool.imap(_undistort_file, filenames):
+            if callback is not None:
+                callback(result)
+            results.append(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def main():
+    usage = '%prog --rad RAD_FILE [options] OUT_DIR INPUT [INPUT ...]'
+    parser = OptionParser(usage, description='INPUT is an image file or a '
+                          'directory of image files.')
+    parser.add_option('--rad', type='string',
+                      help='.rad file with the distortion parameters')
+    parser.add_option('--workers', type='int', default=None,
+                      help='number of worker processes [default: number of '
+                      'CPUs]')
+    parser.add_option('--mode', type='choice', default='bilinear',
+                      choices=['nearest','bilinear','bicubic'],
+                      help='interpolation mode [default: %default]')
+    parser.add_option('--map-dtype', type='choice', default='float64',
+                      choices=['float64','float32','int16'],
+                      help='precision of the coordinate maps [default: '
+                      '%default]')
+    parser.add_option('--no-reshape', action='store_false', default=True,
+                      dest='reshape',
+                      help='keep the size of the original images')
+    parser.add_option('--ext', type='string', default=None,
+                      help='extension (and format) of output images')
+    (options, args) = parser.parse_args()
+
+    if len(args)<2 or options.rad is None:
+        parser.print_help()
+        return 1
+
+    out_dir = args[0]
+    filenames = []
+    for arg in args[1:]:
+        if os.path.isdir(arg):
+            filenames.extend(pipeline.list_image_files(arg))
+        else:
+            filenames.append(arg)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    ext = options.ext
+    if ext is not None and not ext.startswith('.'):
+        ext = '.'+ext
+
+    def report(result):
+        filename, out_name, error = result
+        if error is not None:
+            print >> sys.stderr, 'failed: %s'%filename
+            print >> sys.stderr, error
+
+    model = distortion.read_rad_file(options.rad)
+    results = undistort_files(filenames, model, out_dir,
+                              workers=options.workers,
+                              reshape=options.reshape,
+                              mode=options.mode,
+                              ext=ext,
+                              map_dtype=options.map_dtype,
+                              callback=report)
+    n_failed = len([r for r in results if r[2] is not None])
+    print 'undistorted %d of %d files'%(len(results)-n_failed, len(results))
+    if n_failed:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,18 @@
 """models of non-linear camera distortion"""
+import re
+import contextlib
+
 import numpy as np
-import scipy
-import scipy.ndimage
 
 from enthought.traits.api import HasTraits, Float, Instance, String, File, \
-     Enum, Range
+     Enum, Range, Event
 
 from enthought.traits.ui.api import View, Item, Group, Handler
 from enthought.traits.ui.menu import Action
 
 import pinpoint._caltech_distortion as _cd
 import pinpoint.util as util
+import pinpoint.warp as warp
 
 class NonlinearDistortionModel(HasTraits):
     def distort(self, x, y):
@@ -21,49 +23,265 @@ class NonlinearDistortionModel(HasTraits):
         raise NotImplementedError(
             'this is an abstract base class method - please override')
 
-    def _stackcopy(self,a,b):
-        """a[:,:,0] = a[:,:,1] = ... = b"""
-        if a.ndim == 3:
-            a.transpose().swapaxes(1,2)[:] = b
-        else:
-            a[:] = b
+    def _get_params_key(self):
+        """return a hashable description of the model parameters"""
+        raise NotImplementedError(
+            'this is an abstract base class method - please override')
 
-    def remove_distortion(self,img,reshape=True):
-        img = np.atleast_3d(img)
-        height, width = img.shape[:2]
+    def _clear_remap_cache(self):
+        self._remap_cache = {}
 
-        oshape = np.array(img.shape)
+    def _get_remap_cache(self):
+        try:
+            return self._remap_cache
+        except AttributeError:
+            self._clear_remap_cache()
+            return self._remap_cache
+
+    def _get_remap_geometry(self,height,width,reshape):
+        """return (shape, lowerleft_corner, upperright_corner) of a remap"""
+        oshape = np.array((height,width))
         if reshape:
             lowerleft_corner = np.array(self.undistort(0.,0.))
             upperright_corner = np.array(self.undistort(width-1,height-1))
-            oshape[:2][::-1] = upperright_corner - lowerleft_corner
+            oshape[::-1] = upperright_corner - lowerleft_corner
         else:
             lowerleft_corner = np.array((0.,0.))
             upperright_corner = np.array((width-1.,height-1.))
+        return oshape, lowerleft_corner, upperright_corner
 
-        y,x = np.mgrid[0:oshape[0],0:oshape[1]]
+    def _distort_grid(self,lowerleft_corner,row0,row1,col0,col1):
+        """return the distorted coordinates of a block of output pixels"""
+        y,x = np.mgrid[row0:row1,col0:col1].astype(np.float64)
 
         # center offset
-        if reshape:
-            x += lowerleft_corner[0]
-            y += lowerleft_corner[1]
+        x += lowerleft_corner[0]
+        y += lowerleft_corner[1]
 
         # Calculate reverse coordinates
-        x,y = self.distort(x,y)
+        return self.distort(x,y)
 
-        coords = np.empty(np.r_[3,oshape],dtype=float)
+    def _get_remap_key(self,shape,reshape,dtype):
+        height, width = shape[:2]
+        return (self._get_params_key(), height, width, bool(reshape),
+                np.dtype(dtype).str)
 
-        # y mapping
-        self._stackcopy(coords[0,...],y)
+    def build_remap(self,shape,reshape=True,dtype=np.float64):
+        """return a RemapTable removing distortion from images of shape
 
-        # x mapping
-        self._stackcopy(coords[1,...],x)
+        The coordinate maps are stored with the given dtype: float64,
+        float32 (half the memory) or int16 (a quarter of the memory),
+        in which case they hold fixed point offsets as described in
+        pinpoint.warp.encode_fixed_point(). They are computed in blocks
+        of rows, so no full size float64 scratch arrays are needed.
 
-        # colour band mapping
-        coords[2,...] = range(img.shape[2])
-
-        restored_img = scipy.ndimage.map_coordinates(img,coords,order=1,prefilter=False).squeeze()
-        return restored_img, lowerleft_corner, upperright_corner
+        Tables are cached on the model parameters, the image height
+        and width, the value of reshape and dtype. The cache is
+        cleared whenever a parameter of the model changes.
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float64, np.float32, np.int16):
+            raise ValueError('unsupported remap table dtype %s'%dtype)
+        height, width = shape[:2]
+        key = self._get_remap_key(shape,reshape,dtype)
+        cache = self._get_remap_cache()
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+        oshape, lowerleft_corner, upperright_corner = \
+                self._get_remap_geometry(height,width,reshape)
+
+        x = np.empty(oshape,dtype=dtype)
+        y = np.empty(oshape,dtype=dtype)
+        block_rows = 64
+        for row0 in range(0,oshape[0],block_rows):
+            row1 = min(row0+block_rows,oshape[0])
+            bx,by = self._distort_grid(lowerleft_corner,row0,row1,
+                                       0,oshape[1])
+            if dtype == np.int16:
+                bx,by = warp.encode_fixed_point(bx,by,row0=row0)
+            x[row0:row1] = bx
+            y[row0:row1] = by
+
+        remap = RemapTable(x,y,lowerleft_corner,upperright_corner)
+        cache[key] = remap
+        return remap
+
+    def build_approximate_inverse(self,shape,step=8.0,mode='bilinear'):
+        """return an ApproximateInverse of undistort() for images of shape
+
+        Approximations are cached like remap tables.
+        """
+        height, width = shape[:2]
+        key = ('inverse', self._get_params_key(), height, width,
+               float(step), mode)
+        cache = self._get_remap_cache()
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        approx = ApproximateInverse(self,(height,width),step=step,mode=mode)
+        cache[key] = approx
+        return approx
+
+    def remove_distortion(self,img,reshape=True,mode='bilinear',out=None,
+                          map_dtype=np.float64,roi=None):
+        """return (undistorted image, lowerleft_corner, upperright_corner)
+
+        The undistorted image has the dtype of img and the number of
+        dimensions of img: the shape of the remap table, followed by
+        the colour band dimension of img (if any). If out is given, the
+        result is written into it. map_dtype selects the precision of
+        the cached remap table, see build_remap().
+
+        If roi = (x0, y0, x1, y1) is given, only the region
+        [y0:y1, x0:x1] of the full undistorted image is computed
+        (clipped to the full image). The corners returned are then
+        those of the region, in undistorted coordinates. The region is
+        cut from a cached remap table if there is one, otherwise only
+        its coordinates are computed (and not cached).
+        """
+        img = np.asarray(img)
+        if roi is None:
+            remap = self.build_remap(img.shape,reshape=reshape,
+                                     dtype=map_dtype)
+            restored_img = remap.apply(img,mode=mode,out=out)
+            return (restored_img, remap.lowerleft_corner,
+                    remap.upperright_corner)
+
+        key = self._get_remap_key(img.shape,reshape,map_dtype)
+        remap = self._get_remap_cache().get(key)
+        if remap is not None:
+            oshape = remap.shape
+            lowerleft_corner = remap.lowerleft_corner
+        else:
+            oshape, lowerleft_corner, upperright_corner = \
+                    self._get_remap_geometry(img.shape[0],img.shape[1],
+                                             reshape)
+        x0, y0, x1, y1 = [int(v) for v in roi]
+        x0 = min(max(x0,0),oshape[1])
+        x1 = min(max(x1,x0),oshape[1])
+        y0 = min(max(y0,0),oshape[0])
+        y1 = min(max(y1,y0),oshape[0])
+        if remap is not None:
+            x, y = remap.get_region(x0,y0,x1,y1)
+        else:
+            x, y = self._distort_grid(lowerleft_corner,y0,y1,x0,x1)
+        restored_img = warp.warp(img,x,y,mode=mode,out=out)
+        return (restored_img,
+                lowerleft_corner + (x0,y0),
+                lowerleft_corner + (x1-1,y1-1))
+
+    def sample_undistorted(self,img,xs,ys,mode='bilinear',cval=0.0):
+        """return the undistorted image img at the points (xs, ys)
+
+        xs and ys are undistorted coordinates (as returned by
+        undistort()) and are broadcast against each other. The result
+        has their shape followed by the colour band dimension of img
+        (if any). Points are distorted directly, which needs no
+        iteration, so no remap table is built.
+        """
+        img = np.asarray(img)
+        x, y = self.distort(xs,ys)
+        shape = x.shape
+        x = np.asarray(x).reshape((1,-1))
+        y = np.asarray(y).reshape((1,-1))
+        result = warp.warp(img,x,y,mode=mode,cval=cval)
+        return result.reshape(shape+img.shape[2:])
+
+class RemapTable(object):
+    """source coordinates of every pixel of an undistorted image
+
+    x and y are arrays with the shape of the undistorted image giving
+    the (distorted) coordinates in the original image from which each
+    output pixel is interpolated. They are either floating point
+    arrays or int16 fixed point offsets, see
+    pinpoint.warp.encode_fixed_point().
+    """
+    def __init__(self,x,y,lowerleft_corner,upperright_corner):
+        self.x = x
+        self.y = y
+        self.lowerleft_corner = lowerleft_corner
+        self.upperright_corner = upperright_corner
+
+    @property
+    def shape(self):
+        return self.x.shape
+
+    def get_region(self,x0,y0,x1,y1):
+        """return floating point coordinate maps of [y0:y1, x0:x1]"""
+        x = self.x[y0:y1,x0:x1]
+        y = self.y[y0:y1,x0:x1]
+        if x.dtype == np.int16:
+            x, y = warp.decode_fixed_point(x,y,row0=y0,col0=x0)
+        return x, y
+
+    def apply(self,img,mode='bilinear',threads=None,out=None):
+        """return undistorted version of img
+
+        img may be 2 dimensional or have a third (colour band)
+        dimension, which is preserved. See pinpoint.warp.warp() for
+        the interpolation modes, threading and out.
+        """
+        return warp.warp(img,self.x,self.y,mode=mode,threads=threads,
+                         out=out)
+
+class ApproximateInverse(object):
+    """fast approximation of the undistort() method of a model
+
+    The exact (iterative) undistortion is evaluated once on a grid of
+    distorted coordinates with a spacing of step pixels covering an
+    image of the given shape. Queries interpolate this grid with a
+    fixed number of operations per point, using mode 'bilinear' or
+    'bicubic' (see pinpoint.warp.warp()). Points outside the image
+    are undistorted to NaN.
+
+    The attribute max_error is the largest distance (in undistorted
+    pixels) between the approximation and the exact undistortion,
+    measured on a grid four times as dense as the table.
+    """
+    def __init__(self,model,shape,step=8.0,mode='bilinear'):
+        if mode not in ('bilinear','bicubic'):
+            raise ValueError("mode must be 'bilinear' or 'bicubic'")
+        height, width = shape[:2]
+        self.shape = (height, width)
+        self.step = float(step)
+        self.mode = mode
+
+        # one extra grid point on each side keeps the bicubic
+        # interpolation away from the table edges
+        ny = int(np.ceil((height-1)/self.step))+1
+        nx = int(np.ceil((width-1)/self.step))+1
+        gy,gx = np.mgrid[-1:ny+1,-1:nx+1].astype(np.float64)*self.step
+        self.x_table, self.y_table = model.undistort(gx,gy)
+
+        # test at a quarter of the grid spacing
+        ty,tx = np.mgrid[0:4*ny-3,0:4*nx-3].astype(np.float64)*(self.step/4)
+        tx = np.minimum(tx,width-1)
+        ty = np.minimum(ty,height-1)
+        ex, ey = model.undistort(tx,ty)
+        ax, ay = self.undistort(tx,ty)
+        self.max_error = np.max(np.hypot(ax-ex,ay-ey))
+
+    def undistort(self,x,y):
+        """return approximately undistorted coordinates (ux, uy)"""
+        x = np.asarray(x,dtype=np.float64)
+        y = np.asarray(y,dtype=np.float64)
+        x, y = np.broadcast_arrays(x, y)
+        shape = x.shape
+        height, width = self.shape
+        outside = (x < 0) | (x > width-1) | (y < 0) | (y > height-1)
+        gx = (x/self.step+1.0).reshape((1,-1))
+        gy = (y/self.step+1.0).reshape((1,-1))
+        result = []
+        for table in (self.x_table, self.y_table):
+            u = warp.warp(table,gx,gy,mode=self.mode,threads=1)
+            u = u.reshape(shape)
+            u[outside] = np.nan
+            result.append(u)
+        return tuple(result)
 
 class HasFilename(HasTraits):
     filename = File
@@ -90,6 +308,9 @@ class CaltechNonlinearDistortionModel(NonlinearDistortionModel):
     p2 = Float(0.0, label="p2", desc="2nd tangential disortion term")
     alpha_c = Float(0.0, label="alpha_c", desc="pixel skew" )
 
+    # fired once after any parameter change or batch of changes
+    params_changed = Event
+
     SaveRadFileAction = Action(name = "Save .rad file", action = "do_save_rad_file")
     LoadRadFileAction = Action(name = "Load .rad file", action = "do_load_rad_file")
 
@@ -138,22 +359,82 @@ class CaltechNonlinearDistortionModel(NonlinearDistortionModel):
                        resizable = True,
                        )
 
-    def _anytrait_changed(self,event):
-        self.helper = _cd.CaltechDistortion( self.fc1, self.fc2,
-                                             self.cc1, self.cc2,
-                                             self.k1, self.k2,
-                                             self.p1, self.p2,
-                                             alpha_c=self.alpha_c )
+    def get_scaled_model(self, scale):
+        """return the model for images resized by the factor scale
+
+        Pixel centers are taken to move as in block averaging, that is
+        x' = scale*(x+0.5)-0.5.
+        """
+        return CaltechNonlinearDistortionModel(
+            fc1=self.fc1*scale, fc2=self.fc2*scale,
+            cc1=scale*(self.cc1+0.5)-0.5, cc2=scale*(self.cc2+0.5)-0.5,
+            k1=self.k1, k2=self.k2, p1=self.p1, p2=self.p2,
+            alpha_c=self.alpha_c)
+
+    def _get_params_key(self):
+        return (self.fc1, self.fc2, self.cc1, self.cc2,
+                self.k1, self.k2, self.p1, self.p2, self.alpha_c)
+
+    def _anytrait_changed(self,name,old,new):
+        if name not in RAD_PARAM_NAMES:
+            return
+        # the helper is rebuilt on first use
+        self._clear_remap_cache()
+        self._helper = None
+        if getattr(self,'_batch_depth',0):
+            self._batch_changed = True
+        else:
+            self.params_changed = True
+
+    def _get_helper(self):
+        helper = getattr(self,'_helper',None)
+        if helper is None:
+            helper = _cd.CaltechDistortion( self.fc1, self.fc2,
+                                            self.cc1, self.cc2,
+                                            self.k1, self.k2,
+                                            self.p1, self.p2,
+                                            alpha_c=self.alpha_c )
+            self._helper = helper
+        return helper
+    helper = property(_get_helper)
+
+    @contextlib.contextmanager
+    def batch_update(self):
+        """context manager deferring params_changed to the end of a block
+
+        The individual trait notifications are still sent, but
+        params_changed fires only once when the outermost block ends
+        (and only if a parameter changed).
+        """
+        self._batch_depth = getattr(self,'_batch_depth',0) + 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and getattr(self,'_batch_changed',False):
+                self._batch_changed = False
+                self.params_changed = True
+
+    def set_params(self, **kwargs):
+        """set several parameters, firing params_changed once"""
+        for name in kwargs:
+            if name not in RAD_PARAM_NAMES:
+                raise TypeError("unknown parameter '%s'"%name)
+        with self.batch_update():
+            for name in RAD_PARAM_NAMES:
+                if name in kwargs:
+                    setattr(self,name,kwargs[name])
 
     def distort(self, x, y):
-        # TODO: use numpy arrays natively
-        vfunc = np.vectorize( lambda xx,yy: self.helper.distort(xx,yy) )
-        return vfunc(x,y)
+        return self.helper.distort_array(x,y)
 
-    def undistort(self, x, y):
-        # TODO: use numpy arrays natively
-        vfunc = np.vectorize( lambda xx,yy: self.helper.undistort(xx,yy) )
-        return vfunc(x,y)
+    def undistort(self, x, y, **kwargs):
+        """undistort coordinates
+
+        See CaltechDistortion.undistort_array() for the keyword
+        arguments controlling convergence.
+        """
+        return self.helper.undistort_array(x,y,**kwargs)
 
     def save_to_rad_file( self, fd, comments=None ):
         """save distortion parameters to .rad file
@@ -188,24 +469,212 @@ class CaltechNonlinearDistortionModel(NonlinearDistortionModel):
         rad_fd.write('kc4 = %s;\n'%repr(self.p2))
         rad_fd.write('\n')
         if comments is not None:
-            comments = str(comments)
+            # quotes are escaped as in MATLAB
+            comments = str(comments).replace("'","''")
         rad_fd.write("comments = '%s';\n"%comments)
         rad_fd.write('\n')
         if close_file:
             rad_fd.close()
 
+# parameters of a Caltech model, in the column order of read_rad_files()
+RAD_PARAM_NAMES = ('fc1', 'fc2', 'cc1', 'cc2', 'k1', 'k2', 'p1', 'p2',
+                   'alpha_c')
+
+_RAD_TOKENS = re.compile(r"""
+    (?P<space>[ \t\r]+) |
+    (?P<newline>\n) |
+    (?P<comment>[%#][^\n]*) |
+    (?P<number>[-+]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|
+                       (?:[Ii]nf|[Nn]a[Nn])(?![A-Za-z0-9_]))) |
+    (?P<name>[A-Za-z_]\w*) |
+    (?P<string>'(?:[^'\n]|'')*') |
+    (?P<equals>=) |
+    (?P<end>[;,])
+    """, re.VERBOSE)
+
+def _tokenize_rad(text):
+    """yield (kind, value, lineno) tokens of a .rad file"""
+    pos = 0
+    lineno = 1
+    while pos < len(text):
+        match = _RAD_TOKENS.match(text,pos)
+        if match is None:
+            raise ValueError('invalid character %r on line %d'%(
+                text[pos],lineno))
+        kind = match.lastgroup
+        value = match.group(kind)
+        pos = match.end()
+        if kind == 'newline':
+            yield 'end', value, lineno
+            lineno += 1
+        elif kind not in ('space','comment'):
+            yield kind, value, lineno
+    yield 'end', '', lineno
+
+def parse_rad_file(fd):
+    """return a dict of the variables assigned in a .rad file
+
+    Only assignments of numbers and quoted strings (name = value;) are
+    understood, as written by save_to_rad_file(). Nothing in the file
+    is executed.
+    """
+    fd, close_file = util.open_file(fd,mode='rb')
+    text = fd.read()
+    if close_file:
+        fd.close()
+
+    params = {}
+    statement = []
+    for kind, value, lineno in _tokenize_rad(text):
+        if kind != 'end':
+            statement.append((kind,value))
+            continue
+        if not len(statement):
+            continue
+        kinds = [k for k,v in statement]
+        if kinds[:2] != ['name','equals'] or len(kinds) != 3 or \
+           kinds[2] not in ('number','string'):
+            raise ValueError('cannot parse statement on line %d of .rad '
+                             'file'%lineno)
+        name = statement[0][1]
+        value = statement[2][1]
+        if kinds[2] == 'number':
+            params[name] = float(value)
+        else:
+            params[name] = value[1:-1].replace("''","'")
+        statement = []
+    return params
+
+def _get_rad_kwargs(params):
+    try:
+        return dict(fc1=params['K11'],
+                    fc2=params['K22'],
+                    cc1=params['K13'],
+                    cc2=params['K23'],
+                    k1= params['kc1'],
+                    k2= params['kc2'],
+                    p1= params['kc3'],
+                    p2= params['kc4'],
+                    alpha_c=(params['K12']/params['K11']),
+                    )
+    except KeyError, err:
+        raise ValueError('missing parameter %s in .rad file'%err.args[0])
+
 def read_rad_file(filename):
     """load distortion parameters from a .rad file"""
-    params = {}
-    execfile(filename,params)
-    kwargs = dict(fc1=params['K11'],
-                  fc2=params['K22'],
-                  cc1=params['K13'],
-                  cc2=params['K23'],
-                  k1= params['kc1'],
-                  k2= params['kc2'],
-                  p1= params['kc3'],
-                  p2= params['kc4'],
-                  alpha_c=(params['K12']/params['K11']),
-                  )
+    kwargs = _get_rad_kwargs(parse_rad_file(filename))
     return CaltechNonlinearDistortionModel(**kwargs)
+
+def read_rad_files(filenames):
+    """load the parameters of several .rad files into one array
+
+    Returns a Kx9 array with the parameters of K files in the order
+    given by RAD_PARAM_NAMES.
+    """
+    result = np.empty((len(filenames),len(RAD_PARAM_NAMES)),
+                      dtype=np.float64)
+    for i,filename in enumerate(filenames):
+        kwargs = _get_rad_kwargs(parse_rad_file(filename))
+        result[i] = [kwargs[name] for name in RAD_PARAM_NAMES]
+    return result
+
+def _params_column(index, doc):
+    def fget(self):
+        return self.params[index]
+    def fset(self, value):
+        self.params[index] = value
+    return property(fget, fset, doc=doc)
+
+class CaltechParams(object):
+    """parameters of K Caltech distortion models, stored as arrays
+
+    This is a lightweight alternative to many
+    CaltechNonlinearDistortionModel instances. The parameters are held
+    in the 9xK float64 array params, whose rows (fc1, fc2, cc1, cc2, k1,
+    k2, p1, p2, alpha_c) are also available as attributes. Coordinates
+    of all cameras are distorted or undistorted in a single pass,
+    selecting each point's camera by index.
+    """
+    fc1 = _params_column(0, 'focal length (x)')
+    fc2 = _params_column(1, 'focal length (y)')
+    cc1 = _params_column(2, 'image center (x)')
+    cc2 = _params_column(3, 'image center (y)')
+    k1 = _params_column(4, '1st radial distortion term (for r^2)')
+    k2 = _params_column(5, '2nd radial distortion term (for r^4)')
+    p1 = _params_column(6, '1st tangential distortion term')
+    p2 = _params_column(7, '2nd tangential distortion term')
+    alpha_c = _params_column(8, 'skew coefficient')
+
+    def __init__(self, fc1, fc2, cc1, cc2, k1, k2, p1, p2, alpha_c=0.0):
+        columns = np.broadcast_arrays(*[np.atleast_1d(np.asarray(
+            c,dtype=np.float64)) for c in (fc1, fc2, cc1, cc2,
+                                            k1, k2, p1, p2, alpha_c)])
+        if columns[0].ndim != 1:
+            raise ValueError('parameters must be scalars or 1D arrays')
+        self.params = np.array(columns,dtype=np.float64)
+
+    @classmethod
+    def from_array(cls, arr):
+        """create from a Kx9 array as returned by read_rad_files()"""
+        arr = np.asarray(arr,dtype=np.float64)
+        if arr.ndim != 2 or arr.shape[1] != len(RAD_PARAM_NAMES):
+            raise ValueError('expected a Kx%d array'%len(RAD_PARAM_NAMES))
+        return cls(*arr.T)
+
+    @classmethod
+    def from_models(cls, models):
+        """create from a sequence of CaltechNonlinearDistortionModel"""
+        return cls.from_array([[getattr(model,name)
+                                for name in RAD_PARAM_NAMES]
+                               for model in models])
+
+    @classmethod
+    def from_rad_files(cls, filenames):
+        return cls.from_array(read_rad_files(filenames))
+
+    def as_array(self):
+        """return the parameters as Kx9 array"""
+        return self.params.T.copy()
+
+    def __len__(self):
+        return self.params.shape[1]
+
+    def get_model(self, camera_index):
+        """return a CaltechNonlinearDistortionModel of one camera"""
+        kwargs = dict(zip(RAD_PARAM_NAMES,
+                          self.params[:,camera_index].tolist()))
+        return CaltechNonlinearDistortionModel(**kwargs)
+
+    def set_model(self, camera_index, model):
+        """copy the parameters of a model into the arrays"""
+        self.params[:,camera_index] = [getattr(model,name)
+                                       for name in RAD_PARAM_NAMES]
+
+    def distort(self, x, y, camera_index=0):
+        """distort coordinates, each with the model given by camera_index
+
+        camera_index is broadcast against x and y.
+        """
+        return _cd.batch_distortion(self.params, camera_index, x, y)
+
+    def undistort(self, x, y, camera_index=0):
+        """undistort coordinates, each with the model given by camera_index
+
+        camera_index is broadcast against x and y.
+        """
+        return _cd.batch_distortion(self.params, camera_index, x, y,
+                                    inverse=True)
+
+def test_parse_rad_file():
+    import StringIO
+    # names starting with inf or nan are names, not numbers
+    fd = StringIO.StringIO("info = 3;\n"
+                           "nanny = 2;\n"
+                           "Nan_offset = 1;\n"
+                           "k1 = -Inf; k2 = NaN;\n")
+    params = parse_rad_file(fd)
+    assert params['info'] == 3.0
+    assert params['nanny'] == 2.0
+    assert params['Nan_offset'] == 1.0
+    assert params['k1'] == -np.inf
+    assert np.isnan(params['k2'])
@@ -1,8 +1,12 @@
+import collections
+
 import numpy as np
 import scipy
 import scipy.optimize
+import scipy.sparse
 
 import distortion
+import pinpoint._caltech_distortion as _cd
 
 class Objective(object):
 
@@ -14,6 +18,7 @@ class Objective(object):
                  distortion_center_guess=None,
                  focal_length_x=1000.0,
                  focal_length_y=1000.0,
+                 undistort_cache_size=4,
                  ):
         """
         list_of_lines - sequence of ( Nx2 sequences )
@@ -24,8 +29,30 @@ class Objective(object):
             Focal length of X dimension
         focal_length_y - float
             Focal length of Y dimension ( focal_length_y = focal_length_x * aspect_ratio )
+        undistort_cache_size - int
+            Number of sets of undistorted points kept for reuse
         """
         self._xys = list_of_lines
+
+        # pack all points into contiguous arrays
+        lengths = [len(xys) for xys in list_of_lines]
+        n_points = sum(lengths)
+        points = np.empty((n_points,2),dtype=np.float64)
+        row0 = 0
+        for xys,length in zip(list_of_lines,lengths):
+            if length:
+                points[row0:row0+length] = xys
+            row0 += length
+        self._xd = np.ascontiguousarray(points[:,0])
+        self._yd = np.ascontiguousarray(points[:,1])
+        self._line_index = np.repeat(np.arange(len(lengths)),lengths)
+
+        # LRU cache of undistorted points, keyed on the model
+        # parameters, so that only the point-to-line distances are
+        # recomputed when just the line parameters change
+        self._undistort_cache = collections.OrderedDict()
+        self._undistort_cache_size = undistort_cache_size
+
         self._focal_length_x = focal_length_x
         self._focal_length_y = focal_length_y
         if distortion_center_guess is not None:
@@ -42,13 +69,65 @@ class Objective(object):
         r1 = distortion_model.k1 # 1st radial term
         r2 = distortion_model.k1 # 2st radial term
 
-        params = [x0, y0, r1, r2]
+        theta, dist = fit_lines( self._xd, self._yd, self._line_index,
+                                 len(self._xys) )
+        params = np.empty((4+2*len(theta),),dtype=np.float64)
+        params[:4] = x0, y0, r1, r2
+        params[4::2] = theta
+        params[5::2] = dist
+        return params
 
-        for orig_xys in self._xys:
-            line_params = self._fit_line( orig_xys )
-            params.extend( line_params )
+    def get_params_for_model_params(self, model_params):
+        """return full parameter vector with optimal line parameters
 
-        return np.array(params,dtype=np.float64)
+        The points are undistorted with model_params (cc1, cc2, k1,
+        k2) and the best fitting line parameters are found in closed
+        form.
+        """
+        ux, uy = self._undistort(model_params)
+        theta, dist = fit_lines( ux, uy, self._line_index, len(self._xys) )
+        params = np.empty((4+2*len(theta),),dtype=np.float64)
+        params[:4] = model_params[:4]
+        params[4::2] = theta
+        params[5::2] = dist
+        return params
+
+    def varpro_err_func(self, model_params):
+        """return lm_err_func() with the line parameters eliminated
+
+        This is the variable projection form of the problem: for any
+        model parameters, the line parameters are chosen optimally, so
+        that only the 4 model parameters remain to be optimized.
+        """
+        return self.lm_err_func(self.get_params_for_model_params(model_params))
+
+    def varpro_jac_func(self, model_params):
+        """return the Jacobian of varpro_err_func()
+
+        This uses the approximation of Kaufman (1975), projecting the
+        derivatives with respect to the line parameters out of those
+        with respect to the model parameters.
+        """
+        params = self.get_params_for_model_params(model_params)
+        A, B, line_index = self.lm_jac_blocks(params)
+        is_line = line_index >= 0
+        li = line_index[is_line]
+        Al = A[is_line]
+        Bl = B[is_line]
+        n_lines = len(self._xys)
+
+        # per line 2x2 BtB and 2x4 BtA
+        BtB = np.empty((n_lines,2,2))
+        BtA = np.empty((n_lines,2,4))
+        for i in range(2):
+            for j in range(2):
+                BtB[:,i,j] = np.bincount(li,Bl[:,i]*Bl[:,j],n_lines)
+            for j in range(4):
+                BtA[:,i,j] = np.bincount(li,Bl[:,i]*Al[:,j],n_lines)
+        coef = np.linalg.solve(BtB,BtA) # n_lines x 2 x 4
+        jac = A.copy()
+        jac[is_line] -= np.einsum('ni,nij->nj',Bl,coef[li])
+        return jac
 
     def get_distortion_model_for_params(self,params):
         x0, y0, r1, r2 = params[:4]
@@ -62,27 +141,138 @@ class Objective(object):
         return distortion_model
 
     def lm_err_func(self, params):
-        results = self.lm_err4(params)
-        if self._distortion_center_guess is not None:
-            # add penalty for straying too far from center
-            x0_guess, y0_guess = self._distortion_center_guess
+        n_points = len(self._xd)
+        if self._distortion_center_guess is None:
+            return self.lm_err4(params)
 
-            alpha = 1.0 # penalty coefficient
+        results = np.empty((n_points+2,),dtype=np.float64)
+        self.lm_err4(params,out=results[:n_points])
+
+        # add penalty for straying too far from center
+        x0_guess, y0_guess = self._distortion_center_guess
+
+        alpha = 1.0 # penalty coefficient
 
-            distortion_model = self.get_distortion_model_for_params( params )
-            x0 = distortion_model.cc1
-            y0 = distortion_model.cc2
-            dist2 = np.sqrt((x0-x0_guess)**2 + (y0-y0_guess)**2)
-            results = list(results) + [alpha*dist2]
+        x0, y0 = params[:2]
+        # The squared distance from the guess is added as two
+        # residuals (x and y offsets). Their sum of squares equals
+        # that of a single distance residual, but unlike the
+        # distance they are differentiable at the guess.
+        results[n_points] = alpha*(x0-x0_guess)
+        results[n_points+1] = alpha*(y0-y0_guess)
         return results
 
+    def lm_jac_func(self, params):
+        """return the Jacobian of lm_err_func() with respect to params
+
+        The result has one row per residual and one column per
+        parameter and may be passed as Dfun to scipy.optimize.leastsq.
+        """
+        jac_model, jac_lines, line_index = self.lm_jac_blocks(params)
+        jac = np.zeros((len(jac_model),len(params)))
+        jac[:,:4] = jac_model
+        rows = np.nonzero(line_index >= 0)[0]
+        cols = 4 + 2*line_index[rows]
+        jac[rows,cols] = jac_lines[rows,0]
+        jac[rows,cols+1] = jac_lines[rows,1]
+        return jac
+
+    def lm_jac_sparse(self, params):
+        """return the Jacobian of lm_err_func() as a sparse matrix
+
+        Each residual depends only on the 4 model parameters and the 2
+        parameters of its own line, so the Jacobian has at most 6
+        non-zero entries per row.
+        """
+        jac_model, jac_lines, line_index = self.lm_jac_blocks(params)
+        n_rows = len(jac_model)
+        rows = np.nonzero(line_index >= 0)[0]
+        cols = 4 + 2*line_index[rows]
+        data = np.concatenate((jac_model.ravel(),
+                               jac_lines[rows,0], jac_lines[rows,1]))
+        row_idx = np.concatenate((np.repeat(np.arange(n_rows),4),
+                                  rows, rows))
+        col_idx = np.concatenate((np.tile(np.arange(4),n_rows),
+                                  cols, cols+1))
+        return scipy.sparse.csr_matrix((data,(row_idx,col_idx)),
+                                       shape=(n_rows,len(params)))
+
+    def lm_jac_blocks(self, params):
+        """return the Jacobian of lm_err_func() in block form
+
+        Returns (jac_model, jac_lines, line_index). jac_model is an Mx4
+        array with the derivatives of the M residuals with respect to
+        the model parameters. jac_lines is an Mx2 array with the
+        derivatives with respect to (theta, dist) of the line given by
+        line_index, an array of M ints. The rows of each line are
+        contiguous. The distortion center penalty, if any, is in the last
+        two rows, which have a line_index of -1.
+        """
+        theta = params[4::2]
+        ct = np.cos(theta)[self._line_index]
+        st = np.sin(theta)[self._line_index]
+        ux, uy, dux, duy = _undistort_with_jacobian(
+            params[:4], self._xd, self._yd,
+            self._focal_length_x, self._focal_length_y )
+        jac_model = ct[:,np.newaxis]*dux + st[:,np.newaxis]*duy
+        jac_lines = np.empty((len(self._xd),2))
+        jac_lines[:,0] = -ux*st + uy*ct
+        jac_lines[:,1] = -1.0
+        line_index = self._line_index
+
+        if self._distortion_center_guess is not None:
+            alpha = 1.0 # penalty coefficient
+
+            rows = np.zeros((2,4))
+            rows[0,0] = alpha
+            rows[1,1] = alpha
+            jac_model = np.vstack((jac_model,rows))
+            jac_lines = np.vstack((jac_lines,np.zeros((2,2))))
+            line_index = np.hstack((line_index,[-1,-1]))
+        return jac_model, jac_lines, line_index
+
+    def solve(self, p0, method='schur', **kwargs):
+        """minimize lm_err_func() starting from p0
+
+        method is 'schur' (the default), which uses leastsq_schur()
+        and scales linearly with the number of lines, 'varpro', which
+        eliminates the line parameters by variable projection and
+        optimizes only the model parameters with MINPACK, or
+        'leastsq', which uses MINPACK with a dense Jacobian. Further
+        keyword arguments are passed to the solver.
+
+        Returns the final parameter vector.
+        """
+        if method == 'schur':
+            pfinal, infodict = leastsq_schur(self, p0, **kwargs)
+        elif method == 'varpro':
+            kwargs.setdefault('maxfev',int(1e6))
+            model_params, ier = scipy.optimize.leastsq(
+                self.varpro_err_func,
+                np.array(p0[:4],copy=True),
+                Dfun=self.varpro_jac_func,
+                **kwargs)
+            pfinal = self.get_params_for_model_params(model_params)
+        elif method == 'leastsq':
+            kwargs.setdefault('maxfev',int(1e6))
+            pfinal, ier = scipy.optimize.leastsq(
+                self.lm_err_func,
+                np.array(p0,copy=True), # workaround bug (scipy ticket 637)
+                Dfun=self.lm_jac_func,
+                **kwargs)
+        else:
+            raise ValueError("unknown method '%s'"%method)
+        return pfinal
+
     def sumsq_err(self, params):
         results = self.lm_err4(params)
         results = np.sum( results**2 )
         return results
 
-    def lm_err4(self, params):
-        """
+    def lm_err4(self, params, out=None):
+        """return the distances of the undistorted points from their lines
+
+        If given, the residuals are written into out.
 
         This was implemented after 'Line-Based Correction of Radial
         Lens Distortion' (GMIP 1997) by Prescott and McLean.
@@ -109,42 +299,257 @@ class Objective(object):
         interesting to pursue.
 
         """
-        distortion_model = self.get_distortion_model_for_params( params )
-
-        results = []
-        for i,orig_xys in enumerate(self._xys):
-            # each set of xys should form a line after undistortion
-            new_xys = np.array([distortion_model.undistort( ox, oy ) for (ox,oy) in orig_xys])
-            line_params = params[4+i*2:4+(i+1)*2]
-            d = self._get_dist_from_line( line_params, new_xys )
-            results.extend( list(d) )
-        results = np.array(results)
-        return results
-
-    def _get_dist_from_line( self, line_params, xys ):
-        theta, dist = line_params
-        # point coordinates
-        x0 = xys[:,0]
-        y0 = xys[:,1]
-
-        return (x0*np.cos( theta ) + y0*np.sin( theta ) - dist)
-
-    def _fit_line( self, xys ):
-        #XXX TODO: directly fit line rather than this crazy NL leastsq operation
-
-        def residuals( line_params, xys ):
-            d = self._get_dist_from_line( line_params, xys )
-            return d
-
-        p0 = np.ones((2,))
-        pfinal, ier = scipy.optimize.leastsq( residuals, p0,
-                                              args=( xys, ),
-                                              )
-        if ier not in (1,2,3,4):
-            raise RuntimeError('could not fit line')
-        theta, dist = pfinal
-
-        return theta, dist
+        # each set of xys should form a line after undistortion
+        ux, uy = self._undistort(params)
+        theta = params[4::2]
+        ct = np.cos(theta)[self._line_index]
+        st = np.sin(theta)[self._line_index]
+        dist = params[5::2][self._line_index]
+        if out is None:
+            out = np.empty((len(self._xd),),dtype=np.float64)
+        np.multiply(ux,ct,out)
+        out += uy*st
+        out -= dist
+        return out
+
+    def clear_undistort_cache(self):
+        """forget all cached undistorted points"""
+        self._undistort_cache.clear()
+
+    def _undistort(self, model_params):
+        """return the undistorted points (ux, uy)
+
+        The returned arrays are shared with the cache and must not be
+        modified.
+        """
+        key = tuple([float(v) for v in model_params[:4]])
+        cache = self._undistort_cache
+        try:
+            result = cache.pop(key)
+        except KeyError:
+            pass
+        else:
+            cache[key] = result
+            return result
+
+        if len(cache) and len(cache) >= self._undistort_cache_size:
+            # reuse the arrays of the least recently used entry
+            out_x, out_y = cache.popitem(last=False)[1]
+        else:
+            out_x = np.empty((len(self._xd),),dtype=np.float64)
+            out_y = np.empty((len(self._xd),),dtype=np.float64)
+        x0, y0, r1, r2 = key
+        helper = _cd.CaltechDistortion( self._focal_length_x,
+                                        self._focal_length_y,
+                                        x0, y0, r1, r2, 0.0, 0.0 )
+        result = helper.undistort_array( self._xd, self._yd,
+                                         out_x=out_x, out_y=out_y )
+        if self._undistort_cache_size > 0:
+            cache[key] = result
+        return result
+
+def fit_lines(x, y, line_index, n_lines=None):
+    """fit straight lines to groups of points by total least squares
+
+    The points of line i are those for which line_index is i. The fit
+    is computed in closed form for all lines at once from the
+    principal axes of the point scatter.
+
+    Returns (theta, dist), arrays of length n_lines such that the
+    lines are x*cos(theta) + y*sin(theta) = dist.
+    """
+    line_index = np.asarray(line_index)
+    if n_lines is None:
+        n_lines = line_index.max()+1
+    count = np.bincount(line_index,minlength=n_lines).astype(np.float64)
+    mx = np.bincount(line_index,x,n_lines)/count
+    my = np.bincount(line_index,y,n_lines)/count
+    dx = x - mx[line_index]
+    dy = y - my[line_index]
+    sxx = np.bincount(line_index,dx*dx,n_lines)
+    syy = np.bincount(line_index,dy*dy,n_lines)
+    sxy = np.bincount(line_index,dx*dy,n_lines)
+
+    # the line normal is perpendicular to the major axis of the scatter
+    theta = 0.5*np.arctan2(2.0*sxy,sxx-syy) + np.pi/2.0
+    dist = mx*np.cos(theta) + my*np.sin(theta)
+    return theta, dist
+
+def leastsq_schur(objective, p0, ftol=1.49012e-08, xtol=1.49012e-08,
+                  gtol=0.0, maxiter=1000, lambda0=1e-3, callback=None):
+    """minimize the sum of squares of objective.lm_err_func()
+
+    This is a Levenberg-Marquardt solver exploiting the block
+    structure of the problem: every line has its own 2 parameters and
+    all lines share the 4 model parameters. The damped normal
+    equations are reduced to a 4x4 system with the Schur complement of
+    the 2x2 line blocks, so that the cost of an iteration grows
+    linearly with the number of lines.
+
+    The tolerances have the same meaning as for
+    scipy.optimize.leastsq. If callback is given, it is called as
+    callback(p, iteration, cost) after every successful iteration. The
+    optimization stops if it returns True.
+
+    Returns (pfinal, infodict), where infodict has the keys 'fvec',
+    'nfev', 'njev' and 'mesg'.
+    """
+    p = np.array(p0,dtype=np.float64,copy=True)
+    n_lines = (len(p)-4)//2
+
+    def cost_of(p):
+        fvec = np.asarray(objective.lm_err_func(p))
+        return fvec, np.dot(fvec,fvec)
+
+    fvec, cost = cost_of(p)
+    nfev = 1
+    njev = 0
+    mesg = 'maximum number of iterations reached'
+    scale_a = np.zeros((4,))
+    scale_b = np.zeros((n_lines,2))
+    lam = lambda0
+    nu = 2.0
+
+    for iteration in range(maxiter):
+        A, B, line_index = objective.lm_jac_blocks(p)
+        njev += 1
+        is_line = line_index >= 0
+        li = line_index[is_line]
+        Al = A[is_line]
+        Bl = B[is_line]
+        fl = fvec[is_line]
+
+        # gradient and Gauss-Newton matrix blocks, accumulated per line
+        # (lines without points get zero blocks)
+        g_a = np.dot(A.T,fvec)
+        g_b = np.zeros((n_lines,2))
+        np.add.at(g_b,li,Bl*fl[:,np.newaxis])
+        H_aa = np.dot(A.T,A)
+        H_ab = np.zeros((n_lines,4,2))
+        np.add.at(H_ab,li,Al[:,:,np.newaxis]*Bl[:,np.newaxis,:])
+        H_bb = np.zeros((n_lines,2,2))
+        np.add.at(H_bb,li,Bl[:,:,np.newaxis]*Bl[:,np.newaxis,:])
+
+        if gtol > 0:
+            gnorm = max(np.max(np.abs(g_a)),np.max(np.abs(g_b)))
+            if gnorm <= gtol*np.sqrt(cost):
+                mesg = 'gradient below gtol'
+                break
+
+        # Marquardt scaling by the largest squared column norms seen
+        # so far (like MINPACK), with unit scale for vanishing columns
+        scale_a = np.maximum(scale_a,np.diag(H_aa))
+        scale_b = np.maximum(scale_b,
+                             np.array((H_bb[:,0,0],H_bb[:,1,1])).T)
+        D_a = np.where(scale_a > 0,scale_a,1.0)
+        D_b = np.where(scale_b > 0,scale_b,1.0)
+
+        while 1:
+            D_aa = H_aa + lam*np.diag(D_a)
+            D_bb = H_bb.copy()
+            D_bb[:,0,0] += lam*D_b[:,0]
+            D_bb[:,1,1] += lam*D_b[:,1]
+
+            # invert the 2x2 line blocks
+            det = D_bb[:,0,0]*D_bb[:,1,1] - D_bb[:,0,1]*D_bb[:,1,0]
+            inv_bb = np.empty_like(D_bb)
+            inv_bb[:,0,0] = D_bb[:,1,1]/det
+            inv_bb[:,1,1] = D_bb[:,0,0]/det
+            inv_bb[:,0,1] = -D_bb[:,0,1]/det
+            inv_bb[:,1,0] = -D_bb[:,1,0]/det
+
+            # reduced (Schur complement) system for the model parameters
+            W = np.einsum('nij,njk->nik',H_ab,inv_bb) # n_lines x 4 x 2
+            S = D_aa - np.einsum('nij,nkj->ik',W,H_ab)
+            rhs = -g_a + np.einsum('nij,nj->i',W,g_b)
+            delta_a = np.linalg.solve(S,rhs)
+            delta_b = -np.einsum('nij,nj->ni',inv_bb,
+                                 g_b + np.einsum('nji,j->ni',H_ab,delta_a))
+
+            # reduction of the sum of squares predicted by the
+            # linearization
+            predicted = (-np.dot(g_a,delta_a) - np.sum(g_b*delta_b) +
+                         lam*(np.dot(D_a*delta_a,delta_a) +
+                              np.sum(D_b*delta_b*delta_b)))
+
+            delta = np.concatenate((delta_a,delta_b.ravel()))
+            p_new = p + delta
+            fvec_new, cost_new = cost_of(p_new)
+            nfev += 1
+            if predicted > 0 and cost_new < cost:
+                # update damping from the gain ratio (Nielsen 1999)
+                rho = (cost-cost_new)/predicted
+                lam *= max(1.0/3.0, 1.0-(2.0*rho-1.0)**3)
+                nu = 2.0
+                break
+            lam *= nu
+            nu *= 2.0
+            if lam > 1e16:
+                break
+
+        if not cost_new < cost:
+            mesg = 'no further reduction in the sum of squares'
+            break
+
+        reduction = (cost-cost_new)/cost
+        step_small = (np.sqrt(np.dot(delta,delta)) <=
+                      xtol*(np.sqrt(np.dot(p,p))+xtol))
+        p, fvec, cost = p_new, fvec_new, cost_new
+        if callback is not None and callback(p, iteration, cost):
+            mesg = 'stopped by callback'
+            break
+        if reduction <= ftol and predicted/cost <= ftol:
+            mesg = 'relative reduction in the sum of squares below ftol'
+            break
+        if step_small:
+            mesg = 'relative change of the parameters below xtol'
+            break
+
+    infodict = dict(fvec=fvec, nfev=nfev, njev=njev, mesg=mesg)
+    return p, infodict
+
+def _undistort_with_jacobian(model_params, xd, yd, fc1, fc2, n_iter=20):
+    """undistort points and differentiate with respect to model_params
+
+    model_params is (cc1, cc2, k1, k2) of a Caltech distortion model
+    with focal lengths fc1 and fc2 and no tangential distortion or
+    skew. The fixed point iteration of CaltechDistortion.undistort is
+    repeated here, propagating derivatives (forward mode automatic
+    differentiation), so that the Jacobian is exact for the residuals
+    actually computed, even where the iteration has not converged.
+
+    Returns (ux, uy, dux, duy), where dux and duy are Nx4 arrays.
+    """
+    cc1, cc2, k1, k2 = model_params
+    xd = np.asarray(xd,dtype=np.float64)
+    yd = np.asarray(yd,dtype=np.float64)
+
+    # normalized distorted coordinates
+    xn = (xd-cc1)/fc1
+    yn = (yd-cc2)/fc2
+    dxn = np.zeros((len(xn),4))
+    dyn = np.zeros((len(yn),4))
+    dxn[:,0] = -1.0/fc1
+    dyn[:,1] = -1.0/fc2
+
+    x, y = xn, yn
+    dx, dy = dxn, dyn
+    for i in range(n_iter):
+        r_2 = x*x + y*y
+        k_radial = 1.0 + k1*r_2 + k2*r_2*r_2
+        dk = (k1 + 2.0*k2*r_2)[:,np.newaxis]*2.0*(x[:,np.newaxis]*dx +
+                                                  y[:,np.newaxis]*dy)
+        dk[:,2] += r_2
+        dk[:,3] += r_2*r_2
+        inv_k = (1.0/k_radial)[:,np.newaxis]
+        x, dx = xn/k_radial, (dxn - (xn/k_radial)[:,np.newaxis]*dk)*inv_k
+        y, dy = yn/k_radial, (dyn - (yn/k_radial)[:,np.newaxis]*dk)*inv_k
+
+    dux = fc1*dx
+    duy = fc2*dy
+    dux[:,0] += 1.0
+    duy[:,1] += 1.0
+    return fc1*x + cc1, fc2*y + cc2, dux, duy
 
 def test():
     model = distortion.CaltechNonlinearDistortionModel(cc1=321,
@@ -179,15 +584,10 @@ def test():
     p0 = obj.get_default_p0(model)
     initial_err = obj.sumsq_err(p0)
     print 'initial_err',initial_err
-    pfinal, cov_x, infodict, mesg, ier = scipy.optimize.minpack.leastsq(
-        obj.lm_err_func,
-        np.array(p0,copy=True), # workaround bug (scipy ticket 637)
-        epsfcn=1e-6,
-        ftol=1e-5,
-        xtol=1e-5,
-        maxfev=int(1e6),
-        full_output=True,
-        )
+    pfinal = obj.solve(p0,
+                       ftol=1e-5,
+                       xtol=1e-5,
+                       )
     final_err=obj.sumsq_err( pfinal )
     print 'final_err',final_err
 
@@ -1,5 +1,7 @@
 """interactive GUI app for exploring non-linear distortion of images"""
-from threading import Thread
+import time
+import types
+from threading import Thread, Event, Condition
 from enthought.pyface.api import SplitApplicationWindow, GUI
 
 from enthought.traits.api import HasTraits, Float, Instance, String, File, \
@@ -43,17 +45,64 @@ def draw_lines_on_ax(ax,lines,func=None,display_transform=None):
     ax.set_xlim(xlim)
     ax.set_ylim(ylim)
 
+class EstimationThread(Thread):
+    """estimate distortion parameters in the background
+
+    The latest intermediate parameter vector is passed to
+    on_progress(p, iteration, cost) at most every min_interval
+    seconds, and the result to on_done(pfinal, error). Both are called
+    on the GUI thread.
+    """
+    def __init__(self, obj, p0, on_progress, on_done, min_interval=0.5):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.obj = obj
+        self.p0 = p0
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.min_interval = min_interval
+        self.cancelled = Event()
+        self._last_progress = 0.0
+
+    def cancel(self):
+        """stop the estimation after the current iteration"""
+        self.cancelled.set()
+
+    def _callback(self, p, iteration, cost):
+        now = time.time()
+        if now - self._last_progress >= self.min_interval:
+            self._last_progress = now
+            GUI.invoke_later(self.on_progress, p.copy(), iteration, cost)
+        return self.cancelled.isSet()
+
+    def run(self):
+        try:
+            pfinal = self.obj.solve(self.p0, callback=self._callback)
+        except Exception, err:
+            GUI.invoke_later(self.on_done, None, err)
+            return
+        GUI.invoke_later(self.on_done, pfinal, None)
+
 class RightSidePanel(HasTraits):
     # right or bottom panel depending on direction of split
 #    add_image_file = Button()
     automatically_estimate_distortion = Button()
+    cancel_estimation = Button()
+    estimation_status = String('')
     nonlinear_distortion_model = Instance(NonlinearDistortionModel)
     distorted_image_widgets = traits.Trait([],list)
 
+    _estimation_thread = traits.Any
+    _estimation_objective = traits.Any
+    _model_before_estimation = traits.Any
+
     ## def _add_image_file_changed ( self ):
     ##     # need to figure out how to open a dialog with traits to ask for filename
 
     def _automatically_estimate_distortion_changed ( self ):
+        if self._estimation_thread is not None:
+            # already running
+            return
         print 'estimating'
         # gather lines
         all_lines = []
@@ -65,6 +114,9 @@ class RightSidePanel(HasTraits):
             else:
                 assert np.allclose(heightwidth, diw.distorted_image.shape[:2])
         all_lines = [np.array(xys) for xys in all_lines if len(xys) ] # numpify
+        if not len(all_lines):
+            self.estimation_status = 'no lines to estimate distortion from'
+            return
         h,w = heightwidth
         obj = distortion_estimate.Objective(all_lines,
                                             distortion_center_guess=(w/2.,h/2.),
@@ -77,23 +129,50 @@ class RightSidePanel(HasTraits):
         p0 = obj.get_default_p0(self.nonlinear_distortion_model)
         initial_err = obj.sumsq_err(p0)
         print 'initial_err',initial_err
-        print 'estimating... please wait'
-        pfinal, cov_x, infodict, mesg, ier = scipy.optimize.minpack.leastsq(
-            obj.lm_err_func,
-            np.array(p0,copy=True), # workaround bug (scipy ticket 637)
-            #epsfcn=options.epsfcn,
-            #ftol=options.tol,
-            #xtol=options.tol,
-            maxfev=int(1e6),
-            full_output=True,
-            )
+        self.estimation_status = 'estimating, initial error %g'%initial_err
+
+        self._model_before_estimation = self.nonlinear_distortion_model
+        self._estimation_objective = obj
+        self._estimation_thread = EstimationThread(
+            obj, p0, self._on_estimation_progress, self._on_estimation_done)
+        self._estimation_thread.start()
+
+    def _cancel_estimation_changed( self ):
+        if self._estimation_thread is not None:
+            self._estimation_thread.cancel()
+            self.estimation_status = 'cancelling'
+
+    def _on_estimation_progress(self, p, iteration, cost):
+        thread = self._estimation_thread
+        if thread is None or thread.cancelled.isSet():
+            return
+        self.estimation_status = 'iteration %d, error %g'%(iteration+1,cost)
+        model = self._estimation_objective.get_distortion_model_for_params(p)
+        self.nonlinear_distortion_model = model
+
+    def _on_estimation_done(self, pfinal, error):
+        thread = self._estimation_thread
+        obj = self._estimation_objective
+        self._estimation_thread = None
+        self._estimation_objective = None
+        if error is not None or thread.cancelled.isSet():
+            # restore the model from before the estimation
+            self.nonlinear_distortion_model = self._model_before_estimation
+            if error is not None:
+                self.estimation_status = 'estimation failed: %s'%error
+            else:
+                self.estimation_status = 'estimation cancelled'
+            return
         final_err=obj.sumsq_err( pfinal )
         print 'final_err',final_err
+        self.estimation_status = 'done, final error %g'%final_err
         model = obj.get_distortion_model_for_params(pfinal)
         self.nonlinear_distortion_model = model
 
     traits_view = View( Group(#Item(name='add_image_file',),
                               Item(name='automatically_estimate_distortion',),
+                              Item(name='cancel_estimation',),
+                              Item(name='estimation_status',style='readonly'),
                               Item(name='nonlinear_distortion_model'),
                               label='control',
                               show_border=True,
@@ -102,60 +181,172 @@ class RightSidePanel(HasTraits):
                               ),
                         )
 
-class DisplayWorkThread(Thread):
-    def run(self):
-        if ((not hasattr(self,'nonlinear_distortion_model')) or
-            (self.nonlinear_distortion_model is None)):
-            do_undistortion = False
-        else:
-            do_undistortion = True
-
-        if do_undistortion:
-            im,ll,ur = self.nonlinear_distortion_model.remove_distortion(
-                self.image_data)
+class RenderScheduler(object):
+    """compute renderings in a background thread, drawing only the latest
+
+    request() replaces any request which has not been started yet, so
+    that after a burst of requests only the last one is rendered.
+    compute(is_stale) is called in the worker thread and must not touch
+    matplotlib. It may return early if is_stale() becomes True. Its
+    result is passed to draw(result) on the GUI thread, unless a newer
+    request was made in the meantime. If compute is a generator
+    function, each result it yields is drawn in turn, which allows
+    progressive refinement.
+    """
+    def __init__(self):
+        self._condition = Condition()
+        self._generation = 0
+        self._pending = None
+        self._thread = None
+
+    def request(self, compute, draw):
+        self._condition.acquire()
+        try:
+            self._generation += 1
+            self._pending = (self._generation, compute, draw)
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def is_current(self, generation):
+        return generation == self._generation
+
+    def _run(self):
+        while 1:
+            self._condition.acquire()
+            try:
+                while self._pending is None:
+                    self._condition.wait()
+                generation, compute, draw = self._pending
+                self._pending = None
+            finally:
+                self._condition.release()
+
+            is_stale = lambda: not self.is_current(generation)
+            try:
+                result = compute(is_stale)
+                if isinstance(result, types.GeneratorType):
+                    # deliver each intermediate rendering
+                    for partial in result:
+                        if is_stale():
+                            break
+                        GUI.invoke_later(self._deliver, generation, draw,
+                                         partial)
+                    continue
+            except Exception, err:
+                print 'rendering failed: %s'%err
+                continue
+            if result is not None and not is_stale():
+                GUI.invoke_later(self._deliver, generation, draw, result)
+
+    def _deliver(self, generation, draw, result):
+        if self.is_current(generation):
+            draw(result)
+
+def get_display_image(im, ll, ur, display_transform):
+    """return the image and imshow() keyword arguments for a transform"""
+    kwargs = {}
+    if display_transform == 'flip y':
+        display_im = im
+        kwargs['origin']='lower'
+        kwargs['extent']=(ll[0],ur[0],ll[1],ur[1])
+    elif display_transform == 'identity':
+        display_im = im
+        kwargs['extent']=(ll[0],ur[0],ur[1],ll[1])
+    elif display_transform == 'rotate 180':
+        display_im = np.rot90(np.rot90(im))
+        kwargs['extent']=(ur[0],ll[0],ll[1],ur[1])#(ll[0],ur[0],ur[1],ll[1])
+    elif display_transform == 'rotate 90':
+        display_im = np.rot90(im)
+        kwargs['extent']=(ll[1],ur[1],ll[0],ur[0])
+    elif display_transform == 'rotate 270':
+        display_im = np.rot90(np.rot90(np.rot90(im)))
+        kwargs['extent']=(ur[1],ll[1],ur[0],ll[0])
+    else:
+        raise ValueError("unknown transform '%s'"%display_transform)
+    return display_im, kwargs
+
+def downsample(image_data, factor):
+    """return image_data reduced by averaging blocks of factor x factor"""
+    h = image_data.shape[0]//factor
+    w = image_data.shape[1]//factor
+    im = image_data[:h*factor,:w*factor].astype(np.float32)
+    im = im.reshape((h,factor,w,factor)+image_data.shape[2:])
+    im = im.mean(axis=3).mean(axis=1)
+    if image_data.dtype.kind in 'ui':
+        im += 0.5
+    return im.astype(image_data.dtype)
+
+def get_preview_factor(shape, max_pixels=300000):
+    """return the downsampling factor (1, 4 or 8) of a quick preview"""
+    n_pixels = shape[0]*shape[1]
+    if n_pixels <= max_pixels:
+        return 1
+    elif n_pixels <= 16*max_pixels:
+        return 4
+    return 8
+
+def render_image(image_data, model, lines, display_transform, factor=1,
+                 small_image=None):
+    """compute what is drawn for an image, without touching matplotlib
+
+    Returns (display_im, imshow_kwargs, lines), where the lines are
+    undistorted with model (if given). If factor is larger than 1, the
+    image is downsampled by factor (small_image may hold the result
+    already) and undistorted with a correspondingly scaled model, but
+    is shown in full resolution coordinates.
+    """
+    if factor > 1:
+        if small_image is None:
+            small_image = downsample(image_data, factor)
+        if model is None:
+            im = small_image
+            ll = np.array((0.,0.))
+            ur = np.array(im.shape[:2][::-1])-1.0
         else:
-            im = self.image_data
-            ll = 0,0
-            ur = im.shape[:2][::-1]-np.array([1,1])
-
-        ax = self.mplwidget.axes
-        ax.images=[]
-        ax.lines=[]
-        kwargs = {}
-
-        if self.display_transform == 'flip y':
-            display_im = im
-            kwargs['origin']='lower'
-            kwargs['extent']=(ll[0],ur[0],ll[1],ur[1])
-        elif self.display_transform == 'identity':
-            display_im = im
-            kwargs['extent']=(ll[0],ur[0],ur[1],ll[1])
-        elif self.display_transform == 'rotate 180':
-            display_im = np.rot90(np.rot90(im))
-            kwargs['extent']=(ur[0],ll[0],ll[1],ur[1])#(ll[0],ur[0],ur[1],ll[1])
-        elif self.display_transform == 'rotate 90':
-            display_im = np.rot90(im)
-            kwargs['extent']=(ll[1],ur[1],ll[0],ur[0])
-        elif self.display_transform == 'rotate 270':
-            display_im = np.rot90(np.rot90(np.rot90(im)))
-            kwargs['extent']=(ur[1],ll[1],ur[0],ll[0])
+            im,ll,ur = model.get_scaled_model(1.0/factor).remove_distortion(
+                small_image)
+        # back to full resolution pixel coordinates
+        ll = (np.asarray(ll)+0.5)*factor-0.5
+        ur = (np.asarray(ur)+0.5)*factor-0.5
+    elif model is None:
+        im = image_data
+        ll = 0,0
+        ur = im.shape[:2][::-1]-np.array([1,1])
+    else:
+        im,ll,ur = model.remove_distortion(image_data)
+    if model is None:
+        func = None
+    else:
+        func = model.undistort
+    display_im, kwargs = get_display_image(im, ll, ur, display_transform)
+    drawn_lines = []
+    for line in lines:
+        if not len(line):
+            continue
+        tmp = np.array( line )
+        if func is not None:
+            drawn_lines.append( np.column_stack(func(tmp[:,0],tmp[:,1])) )
         else:
-            raise ValueError("unknown transform '%s'"%self.display_transform)
-
-        ax.imshow(display_im,
-                  aspect='equal',
-                  cmap=cm.pink,
-                  **kwargs)
-
-        if hasattr(self,'lines'):
-            if do_undistortion:
-                func = self.nonlinear_distortion_model.undistort
-            else:
-                func = None
-            draw_lines_on_ax(ax,self.lines,func=func,
-                             display_transform=self.display_transform)
-
-        GUI.invoke_later(self.mplwidget.figure.canvas.draw)
+            drawn_lines.append( tmp )
+    return display_im, kwargs, drawn_lines
+
+def draw_rendering(mplwidget, rendering, display_transform):
+    """show the result of render_image() (on the GUI thread)"""
+    display_im, kwargs, lines = rendering
+    ax = mplwidget.axes
+    ax.images=[]
+    ax.lines=[]
+    ax.imshow(display_im,
+              aspect='equal',
+              cmap=cm.pink,
+              **kwargs)
+    draw_lines_on_ax(ax,lines,display_transform=display_transform)
+    mplwidget.figure.canvas.draw()
 
 class DistortedImageWidget(Widget):
     parent_w_model = Instance(RightSidePanel)
@@ -169,10 +360,17 @@ class DistortedImageWidget(Widget):
     undistorted_mplwidget = Instance(MPLWidget) # the undistorted version
 
     distorted_image = Array
-    distortion_display_thread   = Instance(DisplayWorkThread)
-    undistortion_display_thread = Instance(DisplayWorkThread)
     current_line = traits.Trait([],list)
 
+    # show a downsampled preview while the model is being changed
+    progressive = traits.Bool(True)
+    refine_delay = Float(0.3)
+
+    _distorted_scheduler = Instance(RenderScheduler,())
+    _undistorted_scheduler = Instance(RenderScheduler,())
+    _render_model = traits.Any
+    _small_images = traits.Dict
+
     def __init__(self, parent, distorted_image,
                  parent_w_model, **kwargs):
         self.distorted_image = distorted_image
@@ -191,7 +389,7 @@ class DistortedImageWidget(Widget):
 
     def _register_model(self):
         self.parent_w_model.nonlinear_distortion_model.on_trait_change(
-            self._show_undistorted_image)
+            self._show_undistorted_image, name='params_changed')
         self._show_undistorted_image()
 
     def _create_control(self, parent):
@@ -293,34 +491,66 @@ class DistortedImageWidget(Widget):
 
         self._list_of_lines_changed()
 
+    def _get_render_model(self):
+        """return a snapshot of the distortion model for rendering
+
+        The snapshot is kept while the parameters do not change, so
+        that its cached remap tables are reused.
+        """
+        model = self.parent_w_model.nonlinear_distortion_model
+        if model is None:
+            return None
+        snapshot = self._render_model
+        if (snapshot is None or type(snapshot) is not type(model) or
+            snapshot._get_params_key() != model._get_params_key()):
+            snapshot = model.clone_traits()
+            self._render_model = snapshot
+        return snapshot
+
     def _show_undistorted_image(self):
-        try:
-            if self.undistortion_display_thread.isAlive():
-                # previous call still running. too slow.
-                return
-        except AttributeError:
-            pass
-        self.undistortion_display_thread = DisplayWorkThread()
-        self.undistortion_display_thread.display_transform = self.display_transform
-        self.undistortion_display_thread.lines = self.list_of_lines
-        self.undistortion_display_thread.mplwidget = self.undistorted_mplwidget
-        self.undistortion_display_thread.nonlinear_distortion_model = \
-                                         self.parent_w_model.nonlinear_distortion_model
-        self.undistortion_display_thread.image_data = self.distorted_image
-        self.undistortion_display_thread.start()
+        model = self._get_render_model()
+        image_data = self.distorted_image
+        lines = [list(line) for line in self.list_of_lines]
+        display_transform = self.display_transform
+        mplwidget = self.undistorted_mplwidget
+
+        if self.progressive:
+            factor = get_preview_factor(image_data.shape)
+        else:
+            factor = 1
+        refine_delay = self.refine_delay
+        small_images = self._small_images
+
+        def compute(is_stale):
+            if factor > 1:
+                # quick preview from the downsampled image
+                if factor not in small_images:
+                    small_images[factor] = downsample(image_data, factor)
+                yield render_image(image_data, model, lines,
+                                   display_transform, factor=factor,
+                                   small_image=small_images[factor])
+
+                # refine once the parameters stop changing
+                t_refine = time.time()+refine_delay
+                while time.time() < t_refine:
+                    if is_stale():
+                        return
+                    time.sleep(0.02)
+            yield render_image(image_data, model, lines, display_transform)
+        def draw(rendering):
+            draw_rendering(mplwidget, rendering, display_transform)
+        self._undistorted_scheduler.request(compute, draw)
 
     def _show_distorted_image(self):
-        try:
-            if self.distortion_display_thread.isAlive():
-                # previous call still running. too slow.
-                return
-        except AttributeError:
-            pass
-        self.distortion_display_thread = DisplayWorkThread()
-        self.distortion_display_thread.display_transform = self.display_transform
-        self.distortion_display_thread.mplwidget = self.distorted_mplwidget
-        self.distortion_display_thread.image_data = self.distorted_image
-        self.distortion_display_thread.start()
+        image_data = self.distorted_image
+        display_transform = self.display_transform
+        mplwidget = self.distorted_mplwidget
+
+        def compute(is_stale):
+            return render_image(image_data, None, [], display_transform)
+        def draw(rendering):
+            draw_rendering(mplwidget, rendering, display_transform)
+        self._distorted_scheduler.request(compute, draw)
 
 FIX1 = False
 
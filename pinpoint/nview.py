@@ -0,0 +1,451 @@
+"""N-view calibration datasets
+
+See data/nview/FORMATS.txt for a description of the ASCII (Multi
+Camera Self Calibration Toolbox compatible) layout of a dataset
+directory and of the binary companion layout implemented here.
+"""
+import os
+import glob
+import shutil
+
+import numpy as np
+
+import pinpoint.util as util
+import pinpoint.distortion as distortion
+
+BINARY_FORMAT = 'pinpoint-nview-npy 1'
+
+# columns of the rad_params array
+RAD_PARAM_NAMES = distortion.RAD_PARAM_NAMES
+
+# (name, dtype, isint) of the .dat files of a dataset
+_DAT_FILES = [('Res', np.int64, True),
+              ('IdMat', np.bool_, False),
+              ('points', np.float64, False),
+              ('position_guess', np.float64, False),
+              ]
+
+_TEXT_FILES = ['camera_order.txt', 'description.txt']
+
+def rad_filename(dirname, camera_index):
+    """return the name of the .rad file of a camera (0-based index)"""
+    return os.path.join(dirname,'basename%d.rad'%(camera_index+1))
+
+def read_camera_order(fd):
+    """return the list of camera names in a camera_order.txt file"""
+    fd, close_file = util.open_file(fd,mode='rb')
+    names = [line.strip() for line in fd if line.strip()]
+    if close_file:
+        fd.close()
+    return names
+
+def _rad_files(dirname):
+    filenames = glob.glob(os.path.join(dirname,'basename*.rad'))
+    def index(filename):
+        return int(os.path.basename(filename)[len('basename'):-len('.rad')])
+    filenames.sort(key=index)
+    return filenames
+
+def get_rad_params(model):
+    """return the parameters of a Caltech model in RAD_PARAM_NAMES order"""
+    return np.array([getattr(model,name) for name in RAD_PARAM_NAMES],
+                    dtype=np.float64)
+
+def convert_ascii_to_binary(src_dir, dst_dir):
+    """convert an ASCII dataset directory to the binary layout
+
+    Every .dat file is stored as .npy file of the appropriate dtype.
+    The parameters of the basename*.rad files are stacked into
+    rad_params.npy and the visible observations are stored sparsely
+    in observations.npz. The .rad files and text files are copied
+    unchanged, so that the conversion is lossless.
+    """
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    for name, dtype, isint in _DAT_FILES:
+        src = os.path.join(src_dir,name+'.dat')
+        if not os.path.exists(src):
+            continue
+        M = util.load_dat_file(src,dtype=dtype)
+        np.save(os.path.join(dst_dir,name+'.npy'),M)
+    if (os.path.exists(os.path.join(src_dir,'IdMat.dat')) and
+        os.path.exists(os.path.join(src_dir,'points.dat'))):
+        id_mat = np.load(os.path.join(dst_dir,'IdMat.npy'))
+        points = np.load(os.path.join(dst_dir,'points.npy'))
+        obs = Observations.from_dense(id_mat,points)
+        obs.save(os.path.join(dst_dir,'observations.npz'))
+
+    rad_files = _rad_files(src_dir)
+    if len(rad_files):
+        rad_params = distortion.read_rad_files(rad_files)
+        np.save(os.path.join(dst_dir,'rad_params.npy'),rad_params)
+    for filename in rad_files:
+        shutil.copy(filename,dst_dir)
+    for name in _TEXT_FILES:
+        src = os.path.join(src_dir,name)
+        if os.path.exists(src):
+            shutil.copy(src,dst_dir)
+
+    fd = open(os.path.join(dst_dir,'FORMAT'),mode='wb')
+    fd.write(BINARY_FORMAT+'\n')
+    fd.close()
+
+def convert_binary_to_ascii(src_dir, dst_dir):
+    """convert a binary dataset directory back to the ASCII layout"""
+    check_binary_format(src_dir)
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    for name, dtype, isint in _DAT_FILES:
+        src = os.path.join(src_dir,name+'.npy')
+        if not os.path.exists(src):
+            continue
+        M = np.load(src,mmap_mode='r')
+        util.save_dat_file(M,os.path.join(dst_dir,name+'.dat'),isint=isint)
+    for filename in _rad_files(src_dir):
+        shutil.copy(filename,dst_dir)
+    for name in _TEXT_FILES:
+        src = os.path.join(src_dir,name)
+        if os.path.exists(src):
+            shutil.copy(src,dst_dir)
+
+def is_binary_dataset(dirname):
+    return os.path.exists(os.path.join(dirname,'FORMAT'))
+
+def check_binary_format(dirname):
+    fd = open(os.path.join(dirname,'FORMAT'),mode='rb')
+    version = fd.read().strip()
+    fd.close()
+    if version != BINARY_FORMAT:
+        raise ValueError("unsupported dataset format '%s'"%version)
+
+def load_binary(dirname, mmap_mode='r'):
+    """load the arrays of a binary dataset directory
+
+    The arrays are memory-mapped (unless mmap_mode is None), so only
+    the parts which are actually accessed are read from disk. In
+    particular, the rows of a camera in points.npy are contiguous.
+
+    Returns a dict with the keys 'Res', 'IdMat', 'points',
+    'position_guess', 'rad_params' and 'camera_order'. Missing files
+    give None.
+    """
+    check_binary_format(dirname)
+    result = {}
+    for name in [n for n, dtype, isint in _DAT_FILES] + ['rad_params']:
+        filename = os.path.join(dirname,name+'.npy')
+        if os.path.exists(filename):
+            result[name] = np.load(filename,mmap_mode=mmap_mode)
+        else:
+            result[name] = None
+    filename = os.path.join(dirname,'camera_order.txt')
+    if os.path.exists(filename):
+        result['camera_order'] = read_camera_order(filename)
+    else:
+        result['camera_order'] = None
+    return result
+
+class Observations(object):
+    """visible 2D observations of M points in N cameras, stored sparsely
+
+    The observations are sorted by camera in compressed sparse row
+    (CSR) form: the observations of camera i are those in the range
+    camera_ptr[i]:camera_ptr[i+1] of point_index (the index of the
+    observed point) and xy (a Kx2 array of image coordinates).
+    """
+    def __init__(self, camera_ptr, point_index, xy, n_points):
+        self.camera_ptr = np.asarray(camera_ptr,dtype=np.intp)
+        self.point_index = np.asarray(point_index,dtype=np.intp)
+        self.xy = np.asarray(xy)
+        self.n_points = n_points
+        if self.xy.shape != (len(self.point_index),2):
+            raise ValueError('xy must be a Kx2 array')
+        if self.camera_ptr[-1] != len(self.point_index):
+            raise ValueError('camera_ptr does not match point_index')
+
+    @classmethod
+    def from_dense(cls, id_mat, points):
+        """create from a NxM IdMat array and a (N*3)xM points array"""
+        id_mat = np.asarray(id_mat,dtype=np.bool_)
+        n_cameras, n_points = id_mat.shape
+        camera_index, point_index = np.nonzero(id_mat)
+        camera_ptr = np.zeros((n_cameras+1,),dtype=np.intp)
+        np.cumsum(np.bincount(camera_index,minlength=n_cameras),
+                  out=camera_ptr[1:])
+        xy = np.empty((len(point_index),2),dtype=np.float64)
+        for i in range(n_cameras):
+            sl = slice(camera_ptr[i],camera_ptr[i+1])
+            idx = point_index[sl]
+            xy[sl,0] = points[3*i,idx]
+            xy[sl,1] = points[3*i+1,idx]
+        return cls(camera_ptr, point_index, xy, n_points)
+
+    def to_dense(self):
+        """return (id_mat, points) in the Svoboda layout
+
+        Invisible entries of points are NaN, the homogeneous coordinate
+        of visible entries is 1.
+        """
+        n_cameras = self.n_cameras
+        id_mat = np.zeros((n_cameras,self.n_points),dtype=np.bool_)
+        points = np.empty((3*n_cameras,self.n_points),dtype=np.float64)
+        points.fill(np.nan)
+        camera_index = self.camera_index
+        id_mat[camera_index,self.point_index] = True
+        points[3*camera_index,self.point_index] = self.xy[:,0]
+        points[3*camera_index+1,self.point_index] = self.xy[:,1]
+        points[3*camera_index+2,self.point_index] = 1.0
+        return id_mat, points
+
+    @property
+    def n_cameras(self):
+        return len(self.camera_ptr)-1
+
+    @property
+    def n_observations(self):
+        return len(self.point_index)
+
+    @property
+    def camera_index(self):
+        """the camera of every observation"""
+        return np.repeat(np.arange(self.n_cameras),np.diff(self.camera_ptr))
+
+    def get_camera(self, camera_index):
+        """return (point_index, xy) of the observations of a camera"""
+        sl = slice(self.camera_ptr[camera_index],
+                   self.camera_ptr[camera_index+1])
+        return self.point_index[sl], self.xy[sl]
+
+    def by_point(self):
+        """return the observations grouped by point
+
+        Returns (point_ptr, order), where order sorts the observations
+        by point. The observations of point j are
+        order[point_ptr[j]:point_ptr[j+1]].
+        """
+        order = np.argsort(self.point_index,kind='mergesort')
+        point_ptr = np.zeros((self.n_points+1,),dtype=np.intp)
+        np.cumsum(np.bincount(self.point_index,minlength=self.n_points),
+                  out=point_ptr[1:])
+        return point_ptr, order
+
+    def undistort(self, models):
+        """return new Observations undistorted by per-camera models
+
+        models is either a distortion.CaltechParams instance with the
+        parameters of all N cameras, or a sequence of N distortion
+        models (or None for cameras whose observations are left
+        unchanged).
+        """
+        if isinstance(models, distortion.CaltechParams):
+            x, y = models.undistort(self.xy[:,0],self.xy[:,1],
+                                    self.camera_index)
+            return Observations(self.camera_ptr, self.point_index,
+                                np.column_stack((x,y)), self.n_points)
+        xy = np.array(self.xy,dtype=np.float64)
+        for i,model in enumerate(models):
+            if model is None:
+                continue
+            sl = slice(self.camera_ptr[i],self.camera_ptr[i+1])
+            x, y = model.undistort(xy[sl,0],xy[sl,1])
+            xy[sl,0] = x
+            xy[sl,1] = y
+        return Observations(self.camera_ptr, self.point_index, xy,
+                            self.n_points)
+
+    def save(self, fd):
+        """save to an .npz file"""
+        np.savez(fd, camera_ptr=self.camera_ptr,
+                 point_index=self.point_index, xy=self.xy,
+                 n_points=self.n_points)
+
+    @classmethod
+    def load(cls, fd):
+        """load from an .npz file written by save()"""
+        data = np.load(fd)
+        return cls(data['camera_ptr'], data['point_index'], data['xy'],
+                   int(data['n_points']))
+
+class NViewDataset(object):
+    """an N-view calibration dataset directory
+
+    The directory may be in the ASCII layout or the binary companion
+    layout. Files are loaded lazily, on first access, and binary
+    arrays are memory-mapped.
+
+    Attributes
+    ----------
+    res : Nx2 array
+        Width and height of the N cameras.
+    id_mat : NxM boolean array
+        Visibility of the M points in the N cameras.
+    points : (N*3)xM array
+        Raw (distorted) homogeneous image coordinates of the points.
+    camera_order : list of strings
+        Names of the N cameras.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._binary = is_binary_dataset(dirname)
+        if self._binary:
+            check_binary_format(dirname)
+        self._cache = {}
+        self._models = {}
+
+    def _load(self, name, dtype):
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        if self._binary:
+            filename = os.path.join(self.dirname,name+'.npy')
+            M = np.load(filename,mmap_mode='r')
+        else:
+            filename = os.path.join(self.dirname,name+'.dat')
+            M = util.load_dat_file(filename,dtype=dtype)
+        self._cache[name] = M
+        return M
+
+    @property
+    def res(self):
+        return self._load('Res',np.int64)
+
+    @property
+    def id_mat(self):
+        return self._load('IdMat',np.bool_)
+
+    @property
+    def points(self):
+        return self._load('points',np.float64)
+
+    @property
+    def position_guess(self):
+        return self._load('position_guess',np.float64)
+
+    @property
+    def camera_order(self):
+        try:
+            return self._cache['camera_order']
+        except KeyError:
+            pass
+        names = read_camera_order(os.path.join(self.dirname,
+                                               'camera_order.txt'))
+        self._cache['camera_order'] = names
+        return names
+
+    @property
+    def n_cameras(self):
+        return self.id_mat.shape[0]
+
+    @property
+    def n_points(self):
+        return self.id_mat.shape[1]
+
+    def get_camera_index(self, name):
+        return self.camera_order.index(name)
+
+    def get_camera_points(self, camera_index):
+        """return the 2xM (x,y) coordinates of all points in a camera
+
+        The result is a view into points. Use get_camera_visibility()
+        to select the valid observations.
+        """
+        return self.points[3*camera_index:3*camera_index+2]
+
+    def get_camera_visibility(self, camera_index):
+        return self.id_mat[camera_index]
+
+    def get_frame(self, point_index):
+        """return the observations of one point in all cameras
+
+        Returns (xy, visible), where xy is an Nx2 array of coordinates
+        and visible is a boolean array of length N.
+        """
+        xy = np.array(self.points[:,point_index]).reshape((-1,3))[:,:2]
+        return xy, np.array(self.id_mat[:,point_index])
+
+    def get_distortion_model(self, camera_index):
+        """return the distortion model of a camera, or None if unknown"""
+        try:
+            return self._models[camera_index]
+        except KeyError:
+            pass
+        model = None
+        if self._binary and os.path.exists(
+            os.path.join(self.dirname,'rad_params.npy')):
+            rad_params = np.load(os.path.join(self.dirname,'rad_params.npy'))
+            if camera_index < len(rad_params):
+                kwargs = dict(zip(RAD_PARAM_NAMES,
+                                  rad_params[camera_index]))
+                model = distortion.CaltechNonlinearDistortionModel(**kwargs)
+        else:
+            filename = rad_filename(self.dirname,camera_index)
+            if os.path.exists(filename):
+                model = distortion.read_rad_file(filename)
+        self._models[camera_index] = model
+        return model
+
+    @property
+    def observations(self):
+        """the visible observations as Observations instance"""
+        try:
+            return self._cache['observations']
+        except KeyError:
+            pass
+        filename = os.path.join(self.dirname,'observations.npz')
+        if os.path.exists(filename):
+            obs = Observations.load(filename)
+        else:
+            obs = Observations.from_dense(self.id_mat,self.points)
+        self._cache['observations'] = obs
+        return obs
+
+    def get_distortion_models(self):
+        return [self.get_distortion_model(i) for i in range(self.n_cameras)]
+
+    def get_distortion_params(self):
+        """return a CaltechParams instance for all cameras
+
+        Returns None unless there are distortion parameters for every
+        camera.
+        """
+        if self._binary and os.path.exists(
+            os.path.join(self.dirname,'rad_params.npy')):
+            rad_params = np.load(os.path.join(self.dirname,'rad_params.npy'))
+            if len(rad_params) == self.n_cameras:
+                return distortion.CaltechParams.from_array(rad_params)
+            return None
+        models = self.get_distortion_models()
+        if None in models:
+            return None
+        return distortion.CaltechParams.from_models(models)
+
+    def undistort_observations(self):
+        """return the visible observations, undistorted
+
+        Only real observations are processed; see Observations.
+        """
+        params = self.get_distortion_params()
+        if params is None:
+            params = self.get_distortion_models()
+        return self.observations.undistort(params)
+
+    def undistort_points(self):
+        """return a copy of points with all visible observations undistorted
+
+        Each camera's observations are undistorted with its own
+        distortion model in a single array operation. Invisible
+        observations and those of cameras without a model are copied
+        unchanged.
+        """
+        points = np.array(self.points,dtype=np.float64)
+        id_mat = self.id_mat
+        for camera_index in range(self.n_cameras):
+            model = self.get_distortion_model(camera_index)
+            if model is None:
+                continue
+            visible = np.nonzero(id_mat[camera_index])[0]
+            x, y = model.undistort(points[3*camera_index,visible],
+                                   points[3*camera_index+1,visible])
+            points[3*camera_index,visible] = x
+            points[3*camera_index+1,visible] = y
+        return points
@@ -0,0 +1,203 @@
+"""streaming removal of distortion from sequences of frames
+
+The functions in this module are generators or consume generators so
+that frame sequences of any length can be processed with constant
+memory. Reading and writing happen in background threads, connected
+to the computation by bounded queues.
+"""
+import os
+import sys
+import threading
+import Queue
+from optparse import OptionParser
+
+import numpy as np
+import scipy
+import scipy.misc.pilutil
+
+import pinpoint.distortion as distortion
+
+IMAGE_EXTENSIONS = ('.png','.bmp','.jpg','.jpeg','.tif','.tiff','.pgm','.ppm')
+
+def list_image_files(dirname):
+    """return the sorted filenames of all images in a directory"""
+    filenames = [fname for fname in os.listdir(dirname)
+                 if os.path.splitext(fname)[1].lower() in IMAGE_EXTENSIONS]
+    filenames.sort()
+    return [os.path.join(dirname,fname) for fname in filenames]
+
+def output_filename(filename, out_dir, ext=None):
+    """return the name in out_dir of the output image for filename
+
+    The extension (and so the format) of the original is kept unless
+    ext is given.
+    """
+    base, orig_ext = os.path.splitext(os.path.basename(filename))
+    if ext is not None:
+        orig_ext = ext
+    return os.path.join(out_dir,base+orig_ext)
+
+def iter_frames(filenames):
+    """lazily read frames, yielding (filename, image) tuples"""
+    for filename in filenames:
+        yield filename, scipy.misc.pilutil.imread(filename)
+
+def prefetch(iterable, maxsize=4):
+    """iterate over iterable in a background thread
+
+    At most maxsize items are buffered. Exceptions raised while
+    iterating are re-raised in the calling thread.
+    """
+    queue = Queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put(('item',item)):
+                    return
+        except:
+            put(('error',sys.exc_info()))
+            return
+        put(('done',None))
+
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        while 1:
+            kind, value = queue.get()
+            if kind == 'item':
+                yield value
+            elif kind == 'error':
+                raise value[0], value[1], value[2]
+            else:
+                break
+    finally:
+        stop.set()
+
+def undistort_frames(frames, model, reshape=True, mode='bilinear',
+                     map_dtype=np.float64):
+    """remove distortion from (name, image) tuples
+
+    The remap table of model is computed once per image shape and
+    reused for all further frames.
+    """
+    for name, img in frames:
+        restored_img, ll, ur = model.remove_distortion(img, reshape=reshape,
+                                                       mode=mode,
+                                                       map_dtype=map_dtype)
+        yield name, restored_img
+
+def consume(iterable, func, maxsize=4):
+    """call func(item) for every item of iterable in a background thread
+
+    At most maxsize items are queued for func. Exceptions raised by
+    func are re-raised in the calling thread. Returns the number of
+    items processed.
+    """
+    queue = Queue.Queue(maxsize)
+    errors = []
+
+    def worker():
+        while 1:
+            item = queue.get()
+            if item is queue:
+                break
+            if errors:
+                # drain the queue after an error
+                continue
+            try:
+                func(item)
+            except:
+                errors.append(sys.exc_info())
+
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    count = 0
+    try:
+        for item in iterable:
+            if errors:
+                break
+            queue.put(item)
+            count += 1
+    finally:
+        queue.put(queue)
+        thread.join()
+    if errors:
+        exc_info = errors[0]
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return count
+
+def undistort_sequence(filenames, model, out_dir, reshape=True,
+                       mode='bilinear', ext=None, maxsize=4,
+                       map_dtype=np.float64):
+    """remove distortion from image files and save them to out_dir
+
+    Frames are read ahead and written behind in background threads.
+    Returns the number of frames written.
+    """
+    def save(name_img):
+        name, img = name_img
+        scipy.misc.pilutil.imsave(output_filename(name, out_dir, ext), img)
+
+    frames = prefetch(iter_frames(filenames), maxsize=maxsize)
+    results = undistort_frames(frames, model, reshape=reshape, mode=mode,
+                               map_dtype=map_dtype)
+    return consume(results, save, maxsize=maxsize)
+
+def main():
+    usage = '%prog --rad RAD_FILE IN_DIR OUT_DIR'
+    parser = OptionParser(usage)
+    parser.add_option('--rad', type='string',
+                      help='.rad file with the distortion parameters')
+    parser.add_option('--mode', type='choice', default='bilinear',
+                      choices=['nearest','bilinear','bicubic'],
+                      help='interpolation mode [default: %default]')
+    parser.add_option('--map-dtype', type='choice', default='float64',
+                      choices=['float64','float32','int16'],
+                      help='precision of the coordinate maps; int16 uses '
+                      '1/32 pixel fixed point offsets [default: %default]')
+    parser.add_option('--no-reshape', action='store_false', default=True,
+                      dest='reshape',
+                      help='keep the size of the original images')
+    parser.add_option('--ext', type='string', default=None,
+                      help='extension (and format) of output images')
+    parser.add_option('--prefetch', type='int', default=4,
+                      help='number of frames to buffer [default: %default]')
+    (options, args) = parser.parse_args()
+
+    if len(args)!=2 or options.rad is None:
+        parser.print_help()
+        return 1
+
+    in_dir, out_dir = args
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    ext = options.ext
+    if ext is not None and not ext.startswith('.'):
+        ext = '.'+ext
+
+    model = distortion.read_rad_file(options.rad)
+    filenames = list_image_files(in_dir)
+    n_frames = undistort_sequence(filenames, model, out_dir,
+                                  reshape=options.reshape,
+                                  mode=options.mode,
+                                  ext=ext,
+                                  maxsize=options.prefetch,
+                                  map_dtype=options.map_dtype)
+    print 'undistorted %d frames'%n_frames
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
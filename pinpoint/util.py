@@ -1,3 +1,6 @@
+import os
+import gzip
+
 import numpy as np
 
 def open_file(name_or_obj,mode='rb'):
@@ -13,25 +16,86 @@ def open_file(name_or_obj,mode='rb'):
         close_file = True
     return fd, close_file
 
-def load_dat_file(fd):
+def open_dat_file(name_or_obj):
+    """open a .dat file for reading, decompressing it if gzipped
+
+    Works like open_file(). Files given by name are checked for the
+    gzip signature, regardless of their extension.
+    """
+    fd, close_file = open_file(name_or_obj,mode='rb')
+    if close_file:
+        magic = fd.read(2)
+        fd.seek(0)
+        if magic == '\x1f\x8b':
+            fd = gzip.GzipFile(fileobj=fd,mode='rb')
+    return fd, close_file
+
+def load_dat_file(fd,dtype=np.float64,usecols=None):
     """read a .dat file and return an array
 
+    The file is parsed line by line into a preallocated array, so that
+    the memory required is little more than that of the result.
+
     Parameters
     ----------
     fd : string or file
         If fd is a string, it is treated as a filename. Otherwise, fd
-        is treated as an open file object.
+        is treated as an open file object. Gzip compressed files are
+        decompressed transparently.
+
+    Other Parameters
+    ----------------
+    dtype : data-type
+        Data type of the returned array. Defaults to float64. Use
+        bool for visibility (IdMat.dat) files, for example.
+    usecols : slice or sequence of ints
+        Columns to return. Defaults to all columns.
 
     Returns
     -------
     M : a numpy array
     """
-    fd,close_file = open_file(fd,mode='rb')
-    buf = fd.read()
-    if close_file:
-        fd.close()
-    lines = buf.split('\n')[:-1]
-    return np.array([map(float,line.split()) for line in lines])
+    fd,close_file = open_dat_file(fd)
+    try:
+        M = None
+        n_rows = 0
+        for lineno, line in enumerate(fd):
+            n_fields = len(line.split())
+            if not n_fields:
+                continue
+            row = np.fromstring(line,sep=' ')
+            if len(row) != n_fields:
+                raise ValueError('cannot parse line %d: %r'%(
+                    lineno+1,line.strip()))
+            if usecols is not None:
+                row = row[usecols]
+            if M is None:
+                M = np.empty((_guess_n_rows(fd,len(line)),len(row)),
+                             dtype=dtype)
+            elif n_rows == M.shape[0]:
+                M.resize((2*n_rows,M.shape[1]),refcheck=False)
+            if len(row) != M.shape[1]:
+                raise ValueError('line %d has %d columns, expected %d'%(
+                    lineno+1,len(row),M.shape[1]))
+            M[n_rows] = row
+            n_rows += 1
+    finally:
+        if close_file:
+            fd.close()
+    if M is None:
+        return np.empty((0,),dtype=dtype)
+    M.resize((n_rows,M.shape[1]),refcheck=False)
+    return M
+
+def _guess_n_rows(fd,line_length):
+    """estimate the number of lines in a file from its size"""
+    if isinstance(fd,gzip.GzipFile):
+        return 1024
+    try:
+        size = os.fstat(fd.fileno()).st_size
+    except (AttributeError, IOError, OSError, ValueError):
+        return 1024
+    return max(1, size//max(1,line_length) + 1)
 
 def save_dat_file(M,fd,isint=False):
     """write an array to a .dat file
@@ -52,19 +116,18 @@ def save_dat_file(M,fd,isint=False):
         Set to True to treat array as integer array. Defaults to
         False.
     """
-    def fmt(f):
-        if isint:
-            return '%d'%f
-        else:
-            return '% 8e'%f
+    if isint:
+        fmt = '%d'
+    else:
+        fmt = '% 8e'
     A = np.asarray(M)
     if len(A.shape) == 1:
         A=np.reshape(A, (1,A.shape[0]) )
 
+    # one format string for a whole row
+    row_fmt = ' '.join( [fmt]*A.shape[1] ) + '\n'
     fd,close_file = open_file(fd,mode='wb')
     for i in range(A.shape[0]):
-        buf = ' '.join( map( fmt, A[i,:] ) )
-        fd.write( buf )
-        fd.write( '\n' )
+        fd.write( row_fmt % tuple(A[i,:]) )
     if close_file:
         fd.close()
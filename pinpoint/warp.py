@@ -0,0 +1,177 @@
+"""multi-threaded image warping"""
+import multiprocessing
+import multiprocessing.pool
+import threading
+
+import numpy as np
+
+import pinpoint._warp as _warp
+
+MODES = {'nearest':0,
+         'bilinear':1,
+         'bicubic':2,
+         }
+
+# precision of int16 coordinate maps: 1/32 pixel in a range of +-1024
+# pixels around each output pixel
+FIXED_POINT_BITS = 5
+INVALID_OFFSET = -32768
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(threads):
+    with _pools_lock:
+        pool = _pools.get(threads)
+        if pool is None:
+            pool = multiprocessing.pool.ThreadPool(threads)
+            _pools[threads] = pool
+    return pool
+
+def encode_fixed_point(x, y, bits=FIXED_POINT_BITS, row0=0):
+    """convert a coordinate map to int16 offsets for warp()
+
+    The offsets are relative to the output pixel positions, whose rows
+    start at row0, in units of 1/2**bits pixels. NaN coordinates are
+    encoded as invalid. A ValueError is raised if an offset does not
+    fit into 16 bits.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    scale = float(1 << bits)
+    rows, cols = np.ogrid[row0:row0+x.shape[0],0:x.shape[1]]
+    dx = np.round((x-cols)*scale)
+    dy = np.round((y-rows)*scale)
+    invalid = np.isnan(dx) | np.isnan(dy)
+    dx[invalid] = 0.0
+    dy[invalid] = 0.0
+    if np.any(np.abs(dx) > 32767) or np.any(np.abs(dy) > 32767):
+        raise ValueError('coordinate offsets exceed the range of int16 '
+                         'fixed point numbers with %d fractional bits, use '
+                         'floating point coordinates instead'%bits)
+    dx = dx.astype(np.int16)
+    dy = dy.astype(np.int16)
+    dx[invalid] = INVALID_OFFSET
+    return dx, dy
+
+def decode_fixed_point(dx, dy, bits=FIXED_POINT_BITS, row0=0, col0=0):
+    """convert int16 offsets back to float32 coordinate maps
+
+    row0 and col0 give the output position of dx[0,0], as when
+    decoding a region cut from a larger map. Invalid offsets decode
+    to NaN.
+    """
+    dx = np.asarray(dx)
+    dy = np.asarray(dy)
+    scale = np.float32(1.0/(1 << bits))
+    rows, cols = np.ogrid[row0:row0+dx.shape[0],col0:col0+dx.shape[1]]
+    x = (cols + dx*scale).astype(np.float32)
+    y = (rows + dy*scale).astype(np.float32)
+    x[dx == INVALID_OFFSET] = np.nan
+    return x, y
+
+def warp(img, x, y, mode='bilinear', out=None, cval=0.0, threads=None,
+         tile_rows=64):
+    """sample img at the (distorted) coordinates given by x and y
+
+    The output image has the shape of x and y, plus the colour band
+    dimension of img (if any). All colour bands are sampled with the
+    same 2D coordinate map. The output is split into tiles of
+    tile_rows rows which are computed without the GIL on a pool of
+    threads.
+
+    Parameters
+    ----------
+    img : array
+        2 or 3 dimensional array of dtype uint8, uint16, float32 or
+        float64.
+    x, y : arrays
+        2 dimensional float32 or float64 arrays of the same shape
+        giving the column and row coordinates in img for each output
+        pixel, or int16 offsets from the output pixels as returned by
+        encode_fixed_point() (with the default number of bits).
+
+    Other Parameters
+    ----------------
+    mode : string
+        One of 'nearest', 'bilinear' (default) or 'bicubic'. The
+        bicubic mode uses cubic convolution (Catmull-Rom) and so
+        requires no prefiltering.
+    out : array
+        If given, the result is written into this array, which must
+        have the output shape and the dtype of img.
+    cval : float
+        Value of output pixels which fall outside img.
+    threads : int
+        Number of threads to use. Defaults to the number of CPUs.
+    tile_rows : int
+        Number of output rows computed per task.
+
+    Returns
+    -------
+    out : array
+    """
+    try:
+        imode = MODES[mode]
+    except KeyError:
+        raise ValueError("unknown interpolation mode '%s'"%mode)
+
+    img = np.asarray(img)
+    if img.dtype not in (np.uint8, np.uint16, np.float32, np.float64):
+        # warp other types as float64 and convert the result
+        result = warp(img.astype(np.float64), x, y, mode=mode, cval=cval,
+                      threads=threads, tile_rows=tile_rows)
+        if out is None:
+            return result.astype(img.dtype)
+        out[...] = result
+        return out
+    if img.ndim not in (2,3):
+        raise ValueError('img must be 2 or 3 dimensional')
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+    fixed = x.dtype == np.int16 and y.dtype == np.int16
+    if not fixed:
+        if x.dtype == np.float32 and y.dtype == np.float32:
+            cdtype = np.float32
+        else:
+            cdtype = np.float64
+        x = np.asarray(x, dtype=cdtype)
+        y = np.asarray(y, dtype=cdtype)
+    if x.ndim != 2 or x.shape != y.shape:
+        raise ValueError('x and y must be 2 dimensional and of equal shape')
+
+    oshape = x.shape + img.shape[2:]
+    if out is None:
+        out = np.empty(oshape, dtype=img.dtype)
+    elif out.shape != oshape or out.dtype != img.dtype:
+        raise ValueError('out must have shape %s and dtype %s'%(
+            oshape, img.dtype))
+
+    if img.ndim == 2:
+        bands = [(img, out)]
+    else:
+        bands = [(img[:,:,i], out[:,:,i]) for i in range(img.shape[2])]
+
+    tasks = []
+    for src, dst in bands:
+        for row0 in range(0, oshape[0], tile_rows):
+            row1 = min(row0+tile_rows, oshape[0])
+            tasks.append((src, dst, row0, row1))
+
+    def do_tile(task):
+        src, dst, row0, row1 = task
+        if fixed:
+            _warp.warp_rows_fixed(src, x, y, dst, row0, row1, imode, cval,
+                                  FIXED_POINT_BITS)
+        else:
+            _warp.warp_rows(src, x, y, dst, row0, row1, imode, cval)
+
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    if threads <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            do_tile(task)
+    else:
+        _get_pool(threads).map(do_tile, tasks)
+    return out
@@ -5,6 +5,8 @@ ext_modules = []
 
 ext_modules.append(Extension(name='pinpoint._caltech_distortion',
                              sources=['src/_caltech_distortion.c']))
+ext_modules.append(Extension(name='pinpoint._warp',
+                             sources=['src/_warp.c']))
 
 setup(name='pinpoint',
       description='a Python library for N-view camera calibration',
@@ -18,5 +20,8 @@ setup(name='pinpoint',
       entry_points = {
     'gui_scripts': ['pinpoint_distortion_gui = pinpoint.distortion_gui:main',
                     ],
+    'console_scripts': ['pinpoint_undistort = pinpoint.pipeline:main',
+                        'pinpoint_batch_undistort = pinpoint.batch:main',
+                        ],
     },
       )
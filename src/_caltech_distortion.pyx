@@ -1,4 +1,304 @@
 #emacs, this is -*-Python-*- mode
+cimport cython
+from cython cimport floating
+from libc.stdlib cimport malloc, free
+from libc.math cimport fabs
+
+import numpy as np
+
+cdef struct _caltech_params:
+    double fc1, fc2, cc1, cc2
+    double k1, k2, p1, p2
+    double alpha_c
+
+cdef inline bint _is_converged(_caltech_params* p,
+                               double x, double y, double xd, double yd,
+                               double tol, double* k_radial,
+                               double* delta_x, double* delta_y) nogil:
+    """evaluate the distortion terms at (x,y) and test the residual
+
+    Returns whether the forward model reproduces (xd,yd) to within
+    tol pixels.
+    """
+    cdef double r_2 = x*x + y*y
+    k_radial[0] = 1.0 + (p.k1) * r_2 + (p.k2) * r_2*r_2
+    delta_x[0] = 2.0 * (p.p1)*x*y + (p.p2)*(r_2 + 2.0*x*x)
+    delta_y[0] = (p.p1) * (r_2 + 2.0*y*y)+2.0*(p.p2)*x*y
+    return ((fabs((x*k_radial[0] + delta_x[0] - xd)*p.fc1) <= tol) and
+            (fabs((y*k_radial[0] + delta_y[0] - yd)*p.fc2) <= tol))
+
+cdef inline bint _undistort_point_tol(_caltech_params* p,
+                                      double x_kk, double y_kk,
+                                      double tol, int max_iter,
+                                      bint newton, bint final_check,
+                                      double* xl, double* yl) nogil:
+    """undistort a point, returns whether it converged
+
+    The iteration stops as soon as the forward model reproduces the
+    distorted point to within tol pixels, or after max_iter
+    iterations. If newton is true, Newton steps are used instead of
+    fixed-point steps. The final estimate is only tested if
+    final_check is true, otherwise a point which did not converge
+    earlier is reported as not converged.
+    """
+    cdef double xd, yd, x, y
+    cdef double r_2, k_radial, delta_x, delta_y
+    cdef double res_x, res_y, dk, dk_dx, dk_dy
+    cdef double j11, j12, j21, j22, det
+    cdef bint converged = 0
+    cdef int i
+
+    # undoradial.m / CalTechCal/normalize.m
+
+    xd = ( x_kk - p.cc1 ) / p.fc1
+    yd = ( y_kk - p.cc2 ) / p.fc2
+
+    xd = xd - p.alpha_c * yd
+
+    # comp_distortion_oulu.m
+
+    # initial guess
+    x = xd
+    y = yd
+
+    for i in range(max_iter):
+        if _is_converged(p, x, y, xd, yd, tol,
+                         &k_radial, &delta_x, &delta_y):
+            converged = 1
+            break
+        if newton:
+            # Newton step with the Jacobian of the forward model
+            r_2 = x*x + y*y
+            res_x = x*k_radial + delta_x - xd
+            res_y = y*k_radial + delta_y - yd
+            dk = 2.0*(p.k1 + 2.0*(p.k2)*r_2)
+            dk_dx = dk*x
+            dk_dy = dk*y
+            j11 = k_radial + x*dk_dx + 2.0*(p.p1)*y + 6.0*(p.p2)*x
+            j12 = x*dk_dy + 2.0*(p.p1)*x + 2.0*(p.p2)*y
+            j21 = y*dk_dx + 2.0*(p.p1)*x + 2.0*(p.p2)*y
+            j22 = k_radial + y*dk_dy + 6.0*(p.p1)*y + 2.0*(p.p2)*x
+            det = j11*j22 - j12*j21
+            if det != 0.0:
+                x = x - ( j22*res_x - j12*res_y)/det
+                y = y - (-j21*res_x + j11*res_y)/det
+                continue
+        x = (xd-delta_x)/k_radial
+        y = (yd-delta_y)/k_radial
+    else:
+        if final_check:
+            converged = _is_converged(p, x, y, xd, yd, tol,
+                                      &k_radial, &delta_x, &delta_y)
+
+    # undoradial.m
+
+    xl[0] = (p.fc1)*x + (p.fc1*p.alpha_c)*y + (p.cc1)
+    yl[0] = (p.fc2)*y + (p.cc2)
+    return converged
+
+cdef inline void _undistort_point(_caltech_params* p,
+                                  double x_kk, double y_kk,
+                                  double* xl, double* yl) nogil:
+    # the original fixed number of iterations
+    _undistort_point_tol(p, x_kk, y_kk, -1.0, 20, 0, 0, xl, yl)
+
+cdef inline void _distort_point(_caltech_params* p,
+                                double xl, double yl,
+                                double* xd, double* yd) nogil:
+    cdef double x, y, r_2, r_4, term1
+
+    x = ( xl - p.cc1 ) / p.fc1
+    y = ( yl - p.cc2 ) / p.fc2
+
+    r_2 = x*x + y*y
+    r_4 = r_2*r_2
+    term1 = p.k1*r_2 + p.k2*r_4
+
+    # OpenCV manual (chaper 6, "3D reconstruction", "camera
+    # calibration" section) seems to disagree with
+    # http://www.vision.caltech.edu/bouguetj/calib_doc/htmls/parameters.html
+
+    # Furthermore, implementations in cvundistort.cpp seem still
+    # unrelated.  Finally, project_points2.m in Bouguet's code is
+    # consistent with his webpage and this below.
+
+    xd[0] = x + x*term1 + (2*p.p1*x*y + p.p2*(r_2+2*x*x))
+    yd[0] = y + y*term1 + (p.p1*(r_2+2*y*y) + 2*p.p2*x*y)
+
+    xd[0] = (p.fc1)*xd[0] + (p.cc1)
+    yd[0] = (p.fc2)*yd[0] + (p.cc2)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _distort_1d(_caltech_params* p,
+                      floating[::1] x, floating[::1] y,
+                      floating[::1] out_x, floating[::1] out_y) nogil:
+    cdef Py_ssize_t i
+    cdef double xd, yd
+    for i in range(x.shape[0]):
+        _distort_point(p, x[i], y[i], &xd, &yd)
+        out_x[i] = xd
+        out_y[i] = yd
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _undistort_1d(_caltech_params* p,
+                        floating[::1] x, floating[::1] y,
+                        floating[::1] out_x, floating[::1] out_y,
+                        double tol, int max_iter, bint newton,
+                        unsigned char[::1] converged) nogil:
+    # converged is only written to if it has the length of x
+    cdef Py_ssize_t i
+    cdef double xl, yl
+    cdef bint want_mask = converged.shape[0] == x.shape[0]
+    cdef bint c
+    for i in range(x.shape[0]):
+        c = _undistort_point_tol(p, x[i], y[i], tol, max_iter, newton,
+                                 want_mask, &xl, &yl)
+        out_x[i] = xl
+        out_y[i] = yl
+        if want_mask:
+            converged[i] = c
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _batch_1d(_caltech_params* p, Py_ssize_t n_params,
+                          const Py_ssize_t[::1] camera_index,
+                          floating[::1] x, floating[::1] y,
+                          floating[::1] out_x, floating[::1] out_y,
+                          bint inverse) nogil:
+    """returns the index of the first invalid camera index or -1"""
+    cdef Py_ssize_t i, c
+    cdef double xo, yo
+    for i in range(x.shape[0]):
+        c = camera_index[i]
+        if c < 0 or c >= n_params:
+            return i
+        if inverse:
+            _undistort_point(&p[c], x[i], y[i], &xo, &yo)
+        else:
+            _distort_point(&p[c], x[i], y[i], &xo, &yo)
+        out_x[i] = xo
+        out_y[i] = yo
+    return -1
+
+cdef Py_ssize_t _batch_double(_caltech_params* p, Py_ssize_t n_params,
+                              const Py_ssize_t[::1] camera_index,
+                              double[::1] x, double[::1] y,
+                              double[::1] out_x, double[::1] out_y,
+                              bint inverse):
+    cdef Py_ssize_t result
+    with nogil:
+        result = _batch_1d(p, n_params, camera_index, x, y, out_x, out_y,
+                           inverse)
+    return result
+
+cdef Py_ssize_t _batch_float(_caltech_params* p, Py_ssize_t n_params,
+                             const Py_ssize_t[::1] camera_index,
+                             float[::1] x, float[::1] y,
+                             float[::1] out_x, float[::1] out_y,
+                             bint inverse):
+    cdef Py_ssize_t result
+    with nogil:
+        result = _batch_1d(p, n_params, camera_index, x, y, out_x, out_y,
+                           inverse)
+    return result
+
+def batch_distortion(params, camera_index, x, y, out_x=None, out_y=None,
+                     inverse=False):
+    """distort (or undistort) coordinates with one of several models
+
+    params is a 9xK array, whose rows are fc1, fc2, cc1, cc2, k1, k2,
+    p1, p2 and alpha_c of K cameras. Each coordinate pair in x and y
+    is processed with the parameters of the camera given by
+    camera_index, which is broadcast against x and y. Array handling
+    is otherwise the same as for CaltechDistortion.distort_array().
+
+    Returns (xd, yd), or (xl, yl) if inverse is True.
+    """
+    cdef const double[:, ::1] P = np.ascontiguousarray(params,
+                                                       dtype=np.float64)
+    cdef Py_ssize_t n_params, c, bad
+    cdef _caltech_params* p
+    if P.shape[0] != 9:
+        raise ValueError('params must have 9 rows')
+    n_params = P.shape[1]
+
+    shape, fx, fy, fox, foy, out_x, out_y = _prepare_arrays(
+        x, y, out_x, out_y)
+    fidx = np.ascontiguousarray(np.broadcast_to(camera_index, shape),
+                                dtype=np.intp).reshape(-1)
+
+    p = <_caltech_params*>malloc(max(n_params,1)*sizeof(_caltech_params))
+    if p == NULL:
+        raise MemoryError()
+    try:
+        for c in range(n_params):
+            p[c].fc1 = P[0,c]
+            p[c].fc2 = P[1,c]
+            p[c].cc1 = P[2,c]
+            p[c].cc2 = P[3,c]
+            p[c].k1 = P[4,c]
+            p[c].k2 = P[5,c]
+            p[c].p1 = P[6,c]
+            p[c].p2 = P[7,c]
+            p[c].alpha_c = P[8,c]
+        if fx.dtype == np.float32:
+            bad = _batch_float(p, n_params, fidx, fx, fy, fox, foy,
+                               inverse)
+        else:
+            bad = _batch_double(p, n_params, fidx, fx, fy, fox, foy,
+                                inverse)
+    finally:
+        free(p)
+    if bad >= 0:
+        raise IndexError('camera index %d out of range for %d cameras'%(
+            fidx[bad], n_params))
+    return _finish_arrays(shape, fox, foy, out_x, out_y)
+
+def _prepare_arrays(x, y, out_x, out_y):
+    """broadcast inputs and return flat, contiguous work arrays
+
+    Returns (shape, flat_x, flat_y, flat_out_x, flat_out_y, out_x,
+    out_y). The flat output arrays share memory with out_x and out_y
+    whenever that is possible. Otherwise, the caller must copy the
+    results back.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if x.dtype == np.float32 and y.dtype == np.float32:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    x, y = np.broadcast_arrays(x, y)
+    shape = x.shape
+
+    if out_x is None:
+        out_x = np.empty(shape, dtype=dtype)
+    if out_y is None:
+        out_y = np.empty(shape, dtype=dtype)
+    for out in (out_x, out_y):
+        if out.shape != shape:
+            raise ValueError('output array has shape %s, expected %s'%(
+                out.shape, shape))
+
+    flat_x = np.ascontiguousarray(x, dtype=dtype).reshape(-1)
+    flat_y = np.ascontiguousarray(y, dtype=dtype).reshape(-1)
+
+    flat_out = []
+    for out in (out_x, out_y):
+        if out.dtype == dtype and out.flags.c_contiguous:
+            flat_out.append(out.reshape(-1))
+        else:
+            flat_out.append(np.empty(flat_x.shape, dtype=dtype))
+    return shape, flat_x, flat_y, flat_out[0], flat_out[1], out_x, out_y
+
+def _finish_arrays(shape, flat_out_x, flat_out_y, out_x, out_y):
+    for flat, out in ((flat_out_x, out_x), (flat_out_y, out_y)):
+        if not np.may_share_memory(flat, out):
+            out[...] = flat.reshape(shape)
+    return out_x, out_y
+
 def make_CaltechDistortion(*args,**kw):
     return CaltechDistortion(*args,**kw)
 
@@ -6,6 +306,7 @@ cdef class CaltechDistortion:
     cdef readonly double fc1, fc2, cc1, cc2
     cdef readonly double k1, k2, p1, p2
     cdef readonly double alpha_c
+    cdef _caltech_params _p
 
     def __init__(self, fc1, fc2, cc1, cc2, k1, k2, p1, p2, alpha_c=0 ):
         """create instance of CaltechDistortion
@@ -28,6 +329,16 @@ cdef class CaltechDistortion:
         self.p2 = p2
         self.alpha_c = alpha_c
 
+        self._p.fc1 = self.fc1
+        self._p.fc2 = self.fc2
+        self._p.cc1 = self.cc1
+        self._p.cc2 = self.cc2
+        self._p.k1 = self.k1
+        self._p.k2 = self.k2
+        self._p.p1 = self.p1
+        self._p.p2 = self.p2
+        self._p.alpha_c = self.alpha_c
+
     def __reduce__(self):
         """this allows CaltechDistortion to be pickled"""
         args = (self.fc1, self.fc2, self.cc1, self.cc2,
@@ -45,64 +356,95 @@ cdef class CaltechDistortion:
         See also the OpenCV reference manual, which has the equation
         used.
         """
-
         cdef double xl, yl
-
-        cdef double xd, yd, x, y
-        cdef double r_2, k_radial, delta_x, delta_y
-        cdef int i
-
-        # undoradial.m / CalTechCal/normalize.m
-
-        xd = ( x_kk - self.cc1 ) / self.fc1
-        yd = ( y_kk - self.cc2 ) / self.fc2
-
-        xd = xd - self.alpha_c * yd
-
-        # comp_distortion_oulu.m
-
-        # initial guess
-        x = xd
-        y = yd
-
-        for i from 0<=i<20:
-            r_2 = x*x + y*y
-            k_radial = 1.0 + (self.k1) * r_2 + (self.k2) * r_2*r_2
-            delta_x = 2.0 * (self.p1)*x*y + (self.p2)*(r_2 + 2.0*x*x)
-            delta_y = (self.p1) * (r_2 + 2.0*y*y)+2.0*(self.p2)*x*y
-            x = (xd-delta_x)/k_radial
-            y = (yd-delta_y)/k_radial
-
-        # undoradial.m
-
-        xl = (self.fc1)*x + (self.fc1*self.alpha_c)*y + (self.cc1)
-        yl = (self.fc2)*y + (self.cc2)
+        _undistort_point(&self._p, x_kk, y_kk, &xl, &yl)
         return (xl, yl)
 
     def distort(self, double xl, double yl):
         """distort 2D coordinate pair"""
+        cdef double xd, yd
+        _distort_point(&self._p, xl, yl, &xd, &yd)
+        return (xd, yd)
 
-        cdef double x, y, r_2, term1, xd, yd
+    def distort_array(self, x, y, out_x=None, out_y=None):
+        """distort arrays of 2D coordinates
 
-        x = ( xl - self.cc1 ) / self.fc1
-        y = ( yl - self.cc2 ) / self.fc2
+        x and y are broadcast against each other and may have any
+        number of dimensions. If both are float32, the computation
+        results are stored as float32, otherwise as float64. The
+        results are written to out_x and out_y if given. The GIL is
+        released while the coordinates are computed.
 
-        r_2 = x*x + y*y
-        r_4 = r_2**2
-        term1 = self.k1*r_2 + self.k2*r_4
+        Returns (xd, yd).
+        """
+        shape, fx, fy, fox, foy, out_x, out_y = _prepare_arrays(
+            x, y, out_x, out_y)
+        if fx.dtype == np.float32:
+            self._distort_float(fx, fy, fox, foy)
+        else:
+            self._distort_double(fx, fy, fox, foy)
+        return _finish_arrays(shape, fox, foy, out_x, out_y)
 
-        # OpenCV manual (chaper 6, "3D reconstruction", "camera
-        # calibration" section) seems to disagree with
-        # http://www.vision.caltech.edu/bouguetj/calib_doc/htmls/parameters.html
+    def undistort_array(self, x, y, out_x=None, out_y=None, tol=None,
+                        max_iter=20, newton=False, return_converged=False):
+        """undistort arrays of 2D coordinates
 
-        # Furthermore, implementations in cvundistort.cpp seem still
-        # unrelated.  Finally, project_points2.m in Bouguet's code is
-        # consistent with his webpage and this below.
+        Array handling is the same as for distort_array().
 
-        xd = x + x*term1 + (2*self.p1*x*y + self.p2*(r_2+2*x**2))
-        yd = y + y*term1 + (self.p1*(r_2+2*y**2) + 2*self.p2*x*y)
+        By default, exactly max_iter fixed-point iterations are
+        done. If tol is given, the iteration of each point stops once
+        distorting the estimate reproduces the input to within tol
+        pixels. If newton is True, Newton steps using the derivative of
+        the distortion model are taken instead of fixed-point steps;
+        these converge in far fewer iterations for strong distortion.
 
-        xd = (self.fc1)*xd + (self.cc1)
-        yd = (self.fc2)*yd + (self.cc2)
+        Returns (xl, yl), or (xl, yl, converged) if return_converged is
+        True, where the boolean array converged is True for the points
+        which reached tol.
+        """
+        shape, fx, fy, fox, foy, out_x, out_y = _prepare_arrays(
+            x, y, out_x, out_y)
+        if tol is None:
+            if return_converged:
+                raise ValueError('return_converged requires tol')
+            tol = -1.0
+        if return_converged:
+            converged = np.empty(fx.shape, dtype=np.uint8)
+        else:
+            converged = np.empty((0,), dtype=np.uint8)
+        if fx.dtype == np.float32:
+            self._undistort_float(fx, fy, fox, foy, tol, max_iter, newton,
+                                  converged)
+        else:
+            self._undistort_double(fx, fy, fox, foy, tol, max_iter, newton,
+                                   converged)
+        out_x, out_y = _finish_arrays(shape, fox, foy, out_x, out_y)
+        if return_converged:
+            return out_x, out_y, converged.view(np.bool_).reshape(shape)
+        return out_x, out_y
 
-        return (xd, yd)
+    cdef _distort_double(self, double[::1] x, double[::1] y,
+                         double[::1] out_x, double[::1] out_y):
+        with nogil:
+            _distort_1d(&self._p, x, y, out_x, out_y)
+
+    cdef _distort_float(self, float[::1] x, float[::1] y,
+                        float[::1] out_x, float[::1] out_y):
+        with nogil:
+            _distort_1d(&self._p, x, y, out_x, out_y)
+
+    cdef _undistort_double(self, double[::1] x, double[::1] y,
+                           double[::1] out_x, double[::1] out_y,
+                           double tol, int max_iter, bint newton,
+                           unsigned char[::1] converged):
+        with nogil:
+            _undistort_1d(&self._p, x, y, out_x, out_y, tol, max_iter,
+                          newton, converged)
+
+    cdef _undistort_float(self, float[::1] x, float[::1] y,
+                          float[::1] out_x, float[::1] out_y,
+                          double tol, int max_iter, bint newton,
+                          unsigned char[::1] converged):
+        with nogil:
+            _undistort_1d(&self._p, x, y, out_x, out_y, tol, max_iter,
+                          newton, converged)
@@ -0,0 +1,181 @@
+#emacs, this is -*-Python-*- mode
+"""interpolation kernels for pinpoint.warp
+
+The kernels fill a block of rows of a single 2D output channel and run
+without the GIL, so that several blocks may be computed concurrently
+from Python threads.
+"""
+cimport cython
+from cython cimport floating
+from libc.math cimport floor
+
+ctypedef fused pixel_t:
+    unsigned char
+    unsigned short
+    float
+    double
+
+cdef enum:
+    # marks output pixels without source in fixed point offset maps
+    INVALID_OFFSET = -32768
+
+cdef enum:
+    NEAREST = 0
+    BILINEAR = 1
+    BICUBIC = 2
+
+cdef inline double _cubic_weight(double t) nogil:
+    # Keys cubic convolution kernel with a=-0.5 (Catmull-Rom)
+    if t < 0:
+        t = -t
+    if t < 1.0:
+        return (1.5*t - 2.5)*t*t + 1.0
+    elif t < 2.0:
+        return ((-0.5*t + 2.5)*t - 4.0)*t + 2.0
+    return 0.0
+
+cdef inline Py_ssize_t _clamp(Py_ssize_t i, Py_ssize_t n) nogil:
+    if i < 0:
+        return 0
+    if i >= n:
+        return n-1
+    return i
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double _sample(const pixel_t[:, :] src, double xs, double ys,
+                           int mode, double cval) nogil:
+    cdef Py_ssize_t h = src.shape[0]
+    cdef Py_ssize_t w = src.shape[1]
+    cdef Py_ssize_t ix, iy, i, j
+    cdef double fx, fy, wy, value, row_value
+
+    if not (0.0 <= xs <= w-1.0 and 0.0 <= ys <= h-1.0):
+        # also catches NaN coordinates
+        return cval
+
+    if mode == NEAREST:
+        return src[<Py_ssize_t>(ys+0.5), <Py_ssize_t>(xs+0.5)]
+
+    ix = <Py_ssize_t>floor(xs)
+    iy = <Py_ssize_t>floor(ys)
+    fx = xs - ix
+    fy = ys - iy
+
+    if mode == BILINEAR:
+        i = _clamp(ix+1, w)
+        j = _clamp(iy+1, h)
+        return ((1.0-fy)*((1.0-fx)*src[iy, ix] + fx*src[iy, i]) +
+                fy*((1.0-fx)*src[j, ix] + fx*src[j, i]))
+
+    value = 0.0
+    for j in range(-1, 3):
+        wy = _cubic_weight(j - fy)
+        row_value = 0.0
+        for i in range(-1, 3):
+            row_value += (_cubic_weight(i - fx) *
+                          src[_clamp(iy+j, h), _clamp(ix+i, w)])
+        value += wy*row_value
+    return value
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _warp_rows(const pixel_t[:, :] src,
+                     const floating[:, :] x, const floating[:, :] y,
+                     pixel_t[:, :] out,
+                     Py_ssize_t row0, Py_ssize_t row1,
+                     int mode, double cval, double maxval) nogil:
+    cdef Py_ssize_t row, col
+    cdef double value
+    for row in range(row0, row1):
+        for col in range(out.shape[1]):
+            value = _sample(src, x[row, col], y[row, col], mode, cval)
+            if pixel_t is float or pixel_t is double:
+                out[row, col] = <pixel_t>value
+            else:
+                # round and saturate for integer images
+                value = floor(value + 0.5)
+                if value < 0.0:
+                    value = 0.0
+                elif value > maxval:
+                    value = maxval
+                out[row, col] = <pixel_t>value
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _warp_rows_fixed(const pixel_t[:, :] src,
+                           const short[:, :] dx, const short[:, :] dy,
+                           pixel_t[:, :] out,
+                           Py_ssize_t row0, Py_ssize_t row1,
+                           int mode, double cval, double maxval,
+                           double scale) nogil:
+    cdef Py_ssize_t row, col
+    cdef double value
+    for row in range(row0, row1):
+        for col in range(out.shape[1]):
+            if dx[row, col] == INVALID_OFFSET:
+                value = cval
+            else:
+                value = _sample(src, col + dx[row, col]*scale,
+                                row + dy[row, col]*scale, mode, cval)
+            if pixel_t is float or pixel_t is double:
+                out[row, col] = <pixel_t>value
+            else:
+                value = floor(value + 0.5)
+                if value < 0.0:
+                    value = 0.0
+                elif value > maxval:
+                    value = maxval
+                out[row, col] = <pixel_t>value
+
+def warp_rows(const pixel_t[:, :] src,
+              const floating[:, :] x, const floating[:, :] y,
+              pixel_t[:, :] out,
+              Py_ssize_t row0, Py_ssize_t row1,
+              int mode, double cval):
+    """fill out[row0:row1] by sampling src at (x,y)
+
+    src and out are 2D (single channel) arrays of the same dtype
+    (uint8, uint16, float32 or float64). x and y have the shape of out
+    and the same floating point dtype. mode is 0 (nearest), 1
+    (bilinear) or 2 (bicubic). Samples outside src are set to cval.
+    """
+    cdef double maxval = 0.0
+    if not (pixel_t is float or pixel_t is double):
+        maxval = (1 << (8*sizeof(pixel_t))) - 1
+    if (x.shape[0] != out.shape[0] or x.shape[1] != out.shape[1] or
+        y.shape[0] != out.shape[0] or y.shape[1] != out.shape[1]):
+        raise ValueError('coordinate arrays must have the shape of out')
+    if not (0 <= row0 <= row1 <= out.shape[0]):
+        raise ValueError('invalid row range')
+    if mode not in (NEAREST, BILINEAR, BICUBIC):
+        raise ValueError('unknown interpolation mode %d'%mode)
+    with nogil:
+        _warp_rows(src, x, y, out, row0, row1, mode, cval, maxval)
+
+def warp_rows_fixed(const pixel_t[:, :] src,
+                    const short[:, :] dx, const short[:, :] dy,
+                    pixel_t[:, :] out,
+                    Py_ssize_t row0, Py_ssize_t row1,
+                    int mode, double cval, int bits):
+    """fill out[row0:row1] by sampling src at fixed point offsets
+
+    Like warp_rows(), but the coordinates are given as int16 offsets
+    from the output pixel in units of 1/2**bits pixels, i.e. output
+    pixel (row, col) is sampled at x = col + dx/2**bits, y = row +
+    dy/2**bits. Offsets of -32768 in dx mark pixels set to cval.
+    """
+    cdef double maxval = 0.0
+    cdef double scale = 1.0/(1 << bits)
+    if not (pixel_t is float or pixel_t is double):
+        maxval = (1 << (8*sizeof(pixel_t))) - 1
+    if (dx.shape[0] != out.shape[0] or dx.shape[1] != out.shape[1] or
+        dy.shape[0] != out.shape[0] or dy.shape[1] != out.shape[1]):
+        raise ValueError('offset arrays must have the shape of out')
+    if not (0 <= row0 <= row1 <= out.shape[0]):
+        raise ValueError('invalid row range')
+    if mode not in (NEAREST, BILINEAR, BICUBIC):
+        raise ValueError('unknown interpolation mode %d'%mode)
+    with nogil:
+        _warp_rows_fixed(src, dx, dy, out, row0, row1, mode, cval, maxval,
+                         scale)